@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+
+# Refreshes a set of synthetic feeds served from a local http server, twice: a cold pass that downloads and
+# parses everything and a warm pass that should mostly get 304s. Reports throughput, the time per fetch step,
+# the time spent splicing items into a Gio.ListStore on the main loop and peak RSS, keyed by git commit so
+# runs can be compared across commits.
+#
+#   python3 benchmarks/feed_ingest.py [--feeds 50] [--entries 200] [--latency 20] [--output results.jsonl]
+
+import argparse
+import email.utils
+import hashlib
+import json
+import multiprocessing
+import os
+import queue
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+def make_feed(index, entries, summary_size, feed_format):
+    summary = ('Summary text of the synthetic benchmark feed. ' * (summary_size // 46 + 1))[:summary_size]
+    date = email.utils.formatdate(1672653600 + index * 60, usegmt=True)
+
+    if feed_format == 'atom':
+        items = ''.join('''
+  <entry>
+    <title>Entry %d of feed %d</title>
+    <link href="https://example.com/%d/posts/%d"/>
+    <id>https://example.com/%d/posts/%d</id>
+    <updated>2023-01-02T10:%02d:00Z</updated>
+    <summary>%s</summary>
+  </entry>''' % (i, index, index, i, index, i, i % 60, summary) for i in range(entries))
+
+        return ('''<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <title>Feed %d</title>
+  <id>https://example.com/%d/</id>
+  <updated>2023-01-02T10:00:00Z</updated>%s
+</feed>''' % (index, index, items)).encode()
+
+    items = ''.join('''
+    <item>
+      <title>Entry %d of feed %d</title>
+      <link>https://example.com/%d/posts/%d</link>
+      <guid>https://example.com/%d/posts/%d</guid>
+      <pubDate>%s</pubDate>
+      <description>%s</description>
+    </item>''' % (i, index, index, i, index, i, date, summary) for i in range(entries))
+
+    return ('''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Feed %d</title>
+    <link>https://example.com/%d/</link>
+    <description>Synthetic feed</description>%s
+  </channel>
+</rss>''' % (index, index, items)).encode()
+
+def make_handler(bodies, latency, not_modified):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            time.sleep(latency)
+
+            body = bodies.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            if not_modified and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xml')
+            self.send_header('Content-Length', str(len(body)))
+            if not_modified:
+                self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+# runs in its own process so the server's memory and cpu don't show up in the measurements. Every host
+# is a separate loopback address, so the fetch pool's per-host limit applies as it would for real feeds.
+# Sends the list of base urls, or the error that kept it from starting, through connection.
+def serve(args, connection):
+    try:
+        bodies = {}
+        for i in range(args.feeds):
+            feed_format = args.format if args.format != 'mixed' else ('rss', 'atom')[i % 2]
+            bodies['/feed/%d.xml' % i] = make_feed(i, args.entries, args.summary_size, feed_format)
+
+        handler = make_handler(bodies, args.latency / 1000, not args.no_304)
+        hosts = []
+        for host in range(args.hosts):
+            server = ThreadingHTTPServer(('127.0.0.%d' % (host + 1), 0), handler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            hosts.append('http://%s:%d' % server.server_address)
+    except OSError as e:
+        connection.send(e)
+        return
+
+    connection.send(hosts)
+    threading.Event().wait()
+
+def get_commit():
+    try:
+        commit = subprocess.check_output(('git', 'rev-parse', 'HEAD'), cwd=ROOT, text=True).strip()
+        dirty = subprocess.call(('git', 'diff', '--quiet', 'HEAD'), cwd=ROOT) != 0
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return commit + '-dirty' if dirty else commit
+
+# the applet's FeedItem and reconcile_model, if gtk is available
+def load_applet():
+    sys.path.insert(0, os.path.join(ROOT, 'usr', 'lib', 'status'))
+    try:
+        import feeds
+    except (ImportError, ValueError):
+        return None
+
+    return feeds
+
+def run_pass(engine, sources, applet, models, loaded):
+    calls = queue.SimpleQueue()
+    engine.fetch_pool.dispatch = lambda func, *args: calls.put((func, args))
+
+    stats = {'feeds': 0, 'errors': 0, 'entries': 0, 'apply': 0.0, 'apply_max': 0.0, 'statuses': {}, 'timings': {}}
+
+    def on_fetched(result, source):
+        stats['feeds'] += 1
+        if result is None or result.error:
+            stats['errors'] += 1
+            return
+
+        stats['statuses'][result.status] = stats['statuses'].get(result.status, 0) + 1
+        for (step, seconds) in (result.timings or {}).items():
+            stats['timings'][step] = stats['timings'].get(step, 0) + seconds
+
+        if result.entries is None:
+            return
+
+        stats['entries'] += len(result.entries)
+        if applet is None:
+            return
+
+        # what Feed._parse_url does on the main loop
+        start = time.monotonic()
+        (model, items) = models[source.url]
+        current = {item.item_id: item for item in items}
+        new_items = [current.get(entry.id) or applet.FeedItem(None, entry, True) for entry in result.entries]
+        applet.reconcile_model(model, items, new_items)
+        models[source.url] = (model, new_items)
+        elapsed = time.monotonic() - start
+
+        stats['apply'] += elapsed
+        stats['apply_max'] = max(stats['apply_max'], elapsed)
+
+    start = time.monotonic()
+    for source in sources:
+        engine.refresh(source, lambda result, source=source: on_fetched(result, source), loaded)
+    while stats['feeds'] < len(sources):
+        (func, args) = calls.get()
+        func(*args)
+    wall = time.monotonic() - start
+
+    return {
+        'wall_s': round(wall, 4),
+        'feeds_per_s': round(len(sources) / wall, 1),
+        'entries_per_s': round(stats['entries'] / wall, 1),
+        'entries': stats['entries'],
+        'errors': stats['errors'],
+        'statuses': stats['statuses'],
+        'step_totals_s': {step: round(seconds, 4) for (step, seconds) in stats['timings'].items()},
+        'liststore_s': round(stats['apply'], 4) if applet is not None else None,
+        'liststore_max_ms': round(stats['apply_max'] * 1000, 2) if applet is not None else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure feed refresh throughput against a local http server')
+    parser.add_argument('--feeds', type=int, default=50)
+    parser.add_argument('--entries', type=int, default=200, help='entries per feed')
+    parser.add_argument('--summary-size', type=int, default=500, help='bytes of summary per entry')
+    parser.add_argument('--format', choices=('rss', 'atom', 'mixed'), default='mixed')
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds the server waits before answering')
+    parser.add_argument('--hosts', type=int, default=4, help='number of loopback addresses to spread the feeds over')
+    parser.add_argument('--no-304', action='store_true', help='ignore If-None-Match, so the warm pass only skips by hash')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--per-host', type=int, default=2)
+    parser.add_argument('--output', metavar='PATH', help='append the result as a json line to PATH')
+    args = parser.parse_args()
+
+    # the engine picks its cache and data directories at import time
+    tmp = tempfile.TemporaryDirectory()
+    os.environ['XDG_CACHE_HOME'] = os.path.join(tmp.name, 'cache')
+    os.environ['XDG_DATA_HOME'] = os.path.join(tmp.name, 'data')
+    sys.path.insert(0, os.path.join(ROOT, 'usr', 'lib', 'python3', 'dist-packages'))
+    from status.feed_engine import FeedEngine, FeedSource
+
+    (connection, child_connection) = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(args, child_connection), daemon=True)
+    server.start()
+    hosts = connection.recv()
+    if isinstance(hosts, Exception):
+        parser.error('could not start the server: %s' % hosts)
+
+    try:
+        applet = load_applet()
+        engine = FeedEngine(workers=args.workers, per_host=args.per_host)
+        sources = [FeedSource(engine, 'Feed %d' % i, '%s/feed/%d.xml' % (hosts[i % len(hosts)], i)) for i in range(args.feeds)]
+        models = {}
+        if applet is not None:
+            from gi.repository import Gio
+            models = {source.url: (Gio.ListStore(item_type=applet.FeedItem), []) for source in sources}
+
+        cold = run_pass(engine, sources, applet, models, False)
+        warm = run_pass(engine, sources, applet, models, True)
+        engine.shutdown()
+    finally:
+        server.terminate()
+        tmp.cleanup()
+
+    result = {
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'params': {name: value for (name, value) in vars(args).items() if name != 'output'},
+        'cold': cold,
+        'warm': warm,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+if __name__ == '__main__':
+    main()
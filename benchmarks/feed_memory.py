@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+
+# Reports the memory retained per 10k feed entries by the raw feedparser entries FeedItem used to hold on
+# to, and by the compact Entry records it keeps now.
+#
+#   python3 benchmarks/feed_memory.py [--entries 10000]
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+
+import feedparser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'usr', 'lib', 'python3', 'dist-packages'))
+from status.feed_engine import Entry
+
+def make_feed(count):
+    items = []
+    for i in range(count):
+        items.append('''
+    <item>
+      <title>Entry %d of the synthetic benchmark feed</title>
+      <link>https://example.com/posts/%d</link>
+      <guid>https://example.com/posts/%d</guid>
+      <pubDate>Mon, 02 Jan 2023 10:%02d:00 +0000</pubDate>
+      <category>news</category>
+      <category>benchmarks</category>
+      <description>%s</description>
+      <content:encoded><![CDATA[<p>%s</p>]]></content:encoded>
+      <enclosure url="https://example.com/media/%d.mp3" length="1234567" type="audio/mpeg"/>
+    </item>''' % (i, i, i, i % 60, 'Summary text. ' * 40, 'Full article text. ' * 200, i))
+
+    return ('''<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/">
+  <channel>
+    <title>Benchmark</title>
+    <link>https://example.com/</link>
+    <description>Synthetic feed</description>%s
+  </channel>
+</rss>''' % ''.join(items)).encode()
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+
+    return (result, retained)
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory retained per feed entry')
+    parser.add_argument('--entries', type=int, default=10000)
+    args = parser.parse_args()
+
+    body = make_feed(args.entries)
+    scale = 10000 / args.entries
+
+    (raw, raw_bytes) = measure(lambda: feedparser.parse(body)['entries'])
+    del raw
+    (compact, compact_bytes) = measure(lambda: [Entry.from_info(info) for info in feedparser.parse(body)['entries']])
+    del compact
+
+    print('feedparser entries: %12d bytes per 10k entries' % (raw_bytes * scale))
+    print('Entry records:      %12d bytes per 10k entries' % (compact_bytes * scale))
+    print('reduction:          %11.1fx' % (raw_bytes / compact_bytes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1281 @@
+#!/usr/bin/python3
+
+# Everything about feeds that doesn't need a display: fetching, parsing, the on-disk caches and the read
+# state. The feeds applet builds its pages on top of this, and `feeds --check` uses it on its own.
+
+import argparse
+import calendar
+import collections
+import datetime
+import email.utils
+import feedparser
+import hashlib
+import json
+import mimetypes
+import os
+import queue
+import random
+import re
+import requests
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SCHEMA = 'org.xstatus.feeds'
+TIMEOUT = 15 * 60
+MIN_POLL_INTERVAL = 5 * 60
+MAX_POLL_INTERVAL = 24 * 60 * 60
+MAX_BACKOFF_STEPS = 6
+COMPACT_INTERVAL = 24 * 60 * 60
+
+# same lookup as GLib.get_user_cache_dir() and GLib.get_user_data_dir()
+def get_user_dir(variable, default):
+    path = os.environ.get(variable)
+    if path and os.path.isabs(path):
+        return path
+
+    return os.path.expanduser(default)
+
+CACHE_DIR = os.path.join(get_user_dir('XDG_CACHE_HOME', '~/.cache'), 'status', 'feeds')
+VALIDATORS_PATH = os.path.join(CACHE_DIR, 'validators.json')
+ENTRY_CACHE_DIR = os.path.join(CACHE_DIR, 'entries')
+SEARCH_INDEX_PATH = os.path.join(CACHE_DIR, 'search.db')
+DATA_DIR = os.path.join(get_user_dir('XDG_DATA_HOME', '~/.local/share'), 'status')
+READ_STATE_PATH = os.path.join(DATA_DIR, 'feeds.db')
+ARTICLE_CACHE_DIR = os.path.join(CACHE_DIR, 'articles')
+
+SY_PERIODS = {
+    'hourly': 60 * 60,
+    'daily': 24 * 60 * 60,
+    'weekly': 7 * 24 * 60 * 60,
+    'monthly': 30 * 24 * 60 * 60,
+    'yearly': 365 * 24 * 60 * 60
+}
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+CONTENT_NS = '{http://purl.org/rss/1.0/modules/content/}'
+DC_NS = '{http://purl.org/dc/elements/1.1/}'
+SY_NS = '{http://purl.org/rss/1.0/modules/syndication/}'
+ENTRY_TAGS = ('item', '{http://purl.org/rss/1.0/}item', ATOM_NS + 'entry')
+FEED_TAGS = {'ttl': 'ttl', SY_NS + 'updatePeriod': 'sy_updateperiod', SY_NS + 'updateFrequency': 'sy_updatefrequency'}
+STREAM_CHUNK_SIZE = 64 * 1024
+# counting these is much cheaper than parsing, and tells how long a feed is when the parse stops early
+ENTRY_END_PATTERN = re.compile(rb'</(?:[\w.-]+:)?(?:item|entry)\s*>')
+
+# number of hosts the http session keeps idle connections open to
+HOST_POOLS = 32
+ACCEPT_ENCODING = 'gzip, deflate, br' if brotli is not None else 'gzip, deflate'
+
+PREFETCH_CHUNK_SIZE = 16 * 1024
+
+# longer summaries are only kept on disk and loaded when a row is expanded
+SUMMARY_PREVIEW_LENGTH = 400
+
+SEARCH_LIMIT = 100
+
+# number of fetches each feed keeps diagnostics for
+DIAGNOSTICS_WINDOW = 20
+
+# status is one of 'fetched', 'unchanged', 'not-modified' or 'error', timings maps a step to seconds, code
+# and size are the http status and body size and message says what went wrong
+FetchResult = collections.namedtuple('FetchResult', ('entries', 'changed', 'error', 'lifetime', 'period', 'status', 'timings',
+                                                     'code', 'size', 'message'),
+                                     defaults=('error', None, None, 0, None))
+
+def parse_http_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+# number of seconds the server asked us to wait, from Retry-After on errors or Cache-Control/Expires otherwise
+def get_lifetime(response):
+    headers = response.headers
+
+    if response.status_code in (429, 503) and 'Retry-After' in headers:
+        value = headers['Retry-After'].strip()
+        if value.isdigit():
+            return int(value)
+        retry_at = parse_http_date(value)
+        return retry_at - time.time() if retry_at else None
+
+    for directive in headers.get('Cache-Control', '').split(','):
+        (name, _, value) = directive.strip().partition('=')
+        if name.lower() == 'max-age' and value.isdigit():
+            return int(value)
+
+    if 'Expires' in headers:
+        expires = parse_http_date(headers['Expires'])
+        date = parse_http_date(headers.get('Date')) or time.time()
+        if expires:
+            return expires - date
+
+    return None
+
+# update period advertised by the feed itself through <ttl> or sy:updatePeriod/sy:updateFrequency
+def get_feed_period(feed_info):
+    try:
+        if 'ttl' in feed_info:
+            return int(feed_info['ttl']) * 60
+
+        if 'sy_updateperiod' in feed_info:
+            period = SY_PERIODS.get(feed_info['sy_updateperiod'].strip().lower())
+            frequency = int(feed_info.get('sy_updatefrequency', 1))
+            if period and frequency > 0:
+                return period / frequency
+    except ValueError:
+        pass
+
+    return None
+
+def parse_date(value):
+    if not value:
+        return None
+
+    parsed = email.utils.parsedate_tz(value)
+    if parsed:
+        return time.gmtime(email.utils.mktime_tz(parsed))
+
+    try:
+        date = datetime.datetime.fromisoformat(value.strip())
+    except ValueError:
+        return None
+
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return time.gmtime(calendar.timegm(date.utctimetuple()))
+
+def _get_text(element):
+    if element is None:
+        return ''
+    return ''.join(element.itertext()).strip()
+
+def _entry_from_element(element):
+    def find_text(*tags):
+        for tag in tags:
+            text = _get_text(element.find(tag))
+            if text:
+                return text
+        return ''
+
+    link = element.findtext('link') or element.findtext('{http://purl.org/rss/1.0/}link')
+    if not link:
+        for link_element in element.iter(ATOM_NS + 'link'):
+            if link_element.get('rel', 'alternate') == 'alternate':
+                link = link_element.get('href')
+                break
+
+    enclosures = [{'href': enclosure.get('url')} for enclosure in element.iter('enclosure') if enclosure.get('url')]
+    enclosures.extend({'href': link_element.get('href')} for link_element in element.iter(ATOM_NS + 'link')
+                      if link_element.get('rel') == 'enclosure' and link_element.get('href'))
+
+    published = find_text('pubDate', ATOM_NS + 'published', ATOM_NS + 'updated', DC_NS + 'date')
+    entry = dict(
+        title=find_text('title', '{http://purl.org/rss/1.0/}title', ATOM_NS + 'title'),
+        link=(link or '').strip(),
+        summary=find_text('description', '{http://purl.org/rss/1.0/}description', ATOM_NS + 'summary', CONTENT_NS + 'encoded', ATOM_NS + 'content'),
+        published=published,
+        published_parsed=parse_date(published),
+        enclosures=enclosures
+    )
+    entry['id'] = find_text('guid', ATOM_NS + 'id') or element.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about') or entry['link']
+
+    return entry
+
+# Parses rss/atom incrementally, stopping after max_entries entries or once stop_after entries in a row are
+# already in known_ids, in which case the last entry returned is the last known one. Returns (entries,
+# feed_info, complete). Raises ValueError for anything it can't
+# handle so the caller can fall back to feedparser.
+def parse_feed_stream(body, known_ids=frozenset(), stop_after=0, max_entries=0):
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    entries = []
+    feed_info = {}
+    known_run = 0
+    depth = 0
+    root_seen = False
+
+    try:
+        for offset in range(0, len(body), STREAM_CHUNK_SIZE):
+            parser.feed(body[offset:offset + STREAM_CHUNK_SIZE])
+            for (event, element) in parser.read_events():
+                if event == 'start':
+                    if not root_seen:
+                        root_seen = True
+                        if element.tag not in ('rss', ATOM_NS + 'feed', '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}RDF'):
+                            raise ValueError('not a feed: %s' % element.tag)
+                    if element.tag in ENTRY_TAGS:
+                        depth += 1
+                    continue
+
+                if element.tag in FEED_TAGS and depth == 0:
+                    feed_info[FEED_TAGS[element.tag]] = _get_text(element)
+                elif element.tag in ENTRY_TAGS:
+                    depth -= 1
+                    entry = _entry_from_element(element)
+                    element.clear()
+
+                    entries.append(entry)
+                    if entry['id'] in known_ids:
+                        known_run += 1
+                        if stop_after and known_run >= stop_after:
+                            return (entries, feed_info, False)
+                    else:
+                        known_run = 0
+
+                    if max_entries and len(entries) >= max_entries:
+                        return (entries, feed_info, True)
+
+        parser.close()
+    except ET.ParseError as e:
+        raise ValueError(str(e))
+
+    return (entries, feed_info, True)
+
+def read_opml(path):
+    feeds = []
+    for outline in ET.parse(path).iter('outline'):
+        url = outline.get('xmlUrl')
+        if url:
+            feeds.append((outline.get('title') or outline.get('text') or url, url))
+
+    return feeds
+
+def write_opml(path, feeds):
+    root = ET.Element('opml', version='2.0')
+    ET.SubElement(ET.SubElement(root, 'head'), 'title').text = 'Feeds'
+    body = ET.SubElement(root, 'body')
+    for (name, url) in feeds:
+        ET.SubElement(body, 'outline', type='rss', text=name, title=name, xmlUrl=url)
+
+    tree = ET.ElementTree(root)
+    ET.indent(tree)
+    tree.write(path, encoding='utf-8', xml_declaration=True)
+
+# enclosure urls of a feedparser or stream parsed entry, or of one read back from the cache
+def get_enclosures(info):
+    return tuple(enclosure['href'] if isinstance(enclosure, dict) else enclosure
+                 for enclosure in info.get('enclosures') or () if enclosure)
+
+def get_timestamp(info):
+    if info.get('timestamp') is not None:
+        return info['timestamp']
+    if info.get('published_parsed'):
+        return calendar.timegm(info['published_parsed'])
+    return None
+
+def write_json_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+class ValidatorStore(object):
+    def __init__(self, path=VALIDATORS_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.validators = {}
+        self.stats = {'fetched': 0, 'not-modified': 0, 'unchanged': 0, 'bytes-fetched': 0, 'bytes-saved': 0}
+
+        try:
+            with open(path) as f:
+                self.validators = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get_headers(self, url):
+        with self.lock:
+            info = self.validators.get(url, {})
+
+        headers = {}
+        if 'etag' in info:
+            headers['If-None-Match'] = info['etag']
+        if 'last-modified' in info:
+            headers['If-Modified-Since'] = info['last-modified']
+
+        return headers
+
+    def record_not_modified(self, url):
+        with self.lock:
+            self.stats['not-modified'] += 1
+            self.stats['bytes-saved'] += self.validators.get(url, {}).get('size', 0)
+
+    # returns True if the body differs from the last one seen for this url
+    def update(self, url, headers, body):
+        digest = hashlib.sha1(body).hexdigest()
+
+        with self.lock:
+            old = self.validators.get(url, {})
+            changed = old.get('hash') != digest
+
+            info = {'hash': digest, 'size': len(body)}
+            if 'ETag' in headers:
+                info['etag'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                info['last-modified'] = headers['Last-Modified']
+            self.validators[url] = info
+
+            self.stats['fetched'] += 1
+            self.stats['bytes-fetched'] += len(body)
+            if not changed:
+                self.stats['unchanged'] += 1
+
+            if info != old:
+                write_json_atomic(self.path, self.validators)
+
+        return changed
+
+    def forget(self, url):
+        with self.lock:
+            if self.validators.pop(url, None) is not None:
+                write_json_atomic(self.path, self.validators)
+
+    def describe_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+
+        requests_made = stats['fetched'] + stats['not-modified']
+        skipped = stats['not-modified'] + stats['unchanged']
+        hit_rate = skipped / requests_made * 100 if requests_made else 0
+
+        return '%d requests: %d full (%d unchanged), %d not modified, %d bytes fetched, %d bytes saved, %.0f%% skipped parsing' % \
+            (requests_made, stats['fetched'], stats['unchanged'], stats['not-modified'], stats['bytes-fetched'], stats['bytes-saved'], hit_rate)
+
+class Entry(object):
+    __slots__ = ('id', 'title', 'link', 'summary', 'summary_truncated', 'published', 'timestamp', 'enclosures')
+
+    def __init__(self, entry_id, title, link, summary, published, timestamp, enclosures=()):
+        self.id = entry_id
+        self.title = title
+        self.link = link
+        self.summary_truncated = len(summary) > SUMMARY_PREVIEW_LENGTH
+        self.summary = summary[:SUMMARY_PREVIEW_LENGTH] if self.summary_truncated else summary
+        self.published = published
+        self.timestamp = timestamp
+        self.enclosures = enclosures
+
+    # info is either a feedparser entry or an entry read back from the cache
+    @classmethod
+    def from_info(cls, info):
+        return cls(info.get('id') or info.get('link', ''), info.get('title', ''), info.get('link', ''),
+                   info.get('description') or info.get('summary', ''), info.get('published', ''), get_timestamp(info),
+                   get_enclosures(info))
+
+class EntryCache(object):
+    def __init__(self, path=ENTRY_CACHE_DIR):
+        self.path = path
+
+    def _get_path(self, url):
+        return os.path.join(self.path, hashlib.sha1(url.encode()).hexdigest() + '.json')
+
+    def has(self, url):
+        return os.path.exists(self._get_path(url))
+
+    def load_raw(self, url):
+        try:
+            with open(self._get_path(url)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, url):
+        entries = self.load_raw(url)
+        if entries is None:
+            return None
+
+        return [Entry.from_info(entry) for entry in entries]
+
+    def load_summary(self, url, item_id):
+        for entry in self.load_raw(url) or []:
+            if entry['id'] == item_id:
+                return entry['summary']
+
+        return None
+
+    # entries can be feedparser entries or raw cached ones, summaries are stored in full
+    def save(self, url, entries):
+        cached = []
+        for info in entries:
+            cached.append({
+                'id': info.get('id') or info.get('link', ''),
+                'title': info.get('title', ''),
+                'link': info.get('link', ''),
+                'summary': info.get('description') or info.get('summary', ''),
+                'published': info.get('published', ''),
+                'timestamp': get_timestamp(info),
+                'enclosures': list(get_enclosures(info))
+            })
+
+        try:
+            write_json_atomic(self._get_path(url), cached)
+        except OSError:
+            traceback.print_exc()
+
+    def remove(self, url):
+        try:
+            os.remove(self._get_path(url))
+        except FileNotFoundError:
+            pass
+
+# every entry ever seen, indexed for full text search on title and summary. Falls back to LIKE queries
+# when sqlite was built without fts5.
+class SearchIndex(object):
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                            'rowid INTEGER PRIMARY KEY, url TEXT NOT NULL, item_id TEXT NOT NULL, title TEXT, summary TEXT, '
+                            'link TEXT, published TEXT, timestamp REAL, UNIQUE (url, item_id))')
+
+        try:
+            with self.db:
+                self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5("
+                                "title, summary, content='entries', content_rowid='rowid')")
+                self.db.execute('CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN '
+                                'INSERT INTO entries_fts (rowid, title, summary) VALUES (new.rowid, new.title, new.summary); END')
+                self.db.execute('CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN '
+                                "INSERT INTO entries_fts (entries_fts, rowid, title, summary) VALUES ('delete', old.rowid, old.title, old.summary); END")
+                self.db.execute('CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE ON entries BEGIN '
+                                "INSERT INTO entries_fts (entries_fts, rowid, title, summary) VALUES ('delete', old.rowid, old.title, old.summary); "
+                                'INSERT INTO entries_fts (rowid, title, summary) VALUES (new.rowid, new.title, new.summary); END')
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+
+    # summaries maps ids to the full summary of entries that only carry the preview. Rows indexed from a
+    # preview before are given the full summary when it turns up.
+    def add(self, url, entries, summaries={}):
+        with self.db:
+            self.db.executemany('INSERT INTO entries (url, item_id, title, summary, link, published, timestamp) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                                'ON CONFLICT (url, item_id) DO UPDATE SET summary = excluded.summary '
+                                'WHERE length(excluded.summary) > length(entries.summary)',
+                                ((url, entry.id, entry.title, summaries.get(entry.id, entry.summary), entry.link, entry.published, entry.timestamp)
+                                 for entry in entries))
+
+    def load_summary(self, url, item_id):
+        row = self.db.execute('SELECT summary FROM entries WHERE url = ? AND item_id = ?', (url, item_id)).fetchone()
+        return row[0] if row is not None else None
+
+    def remove_feed(self, url):
+        with self.db:
+            self.db.execute('DELETE FROM entries WHERE url = ?', (url,))
+
+    # returns (url, Entry) pairs, every word in text has to match the start of a word in the title or summary
+    def search(self, text, limit=SEARCH_LIMIT):
+        words = text.split()
+        if not words:
+            return []
+
+        columns = 'e.url, e.item_id, e.title, e.link, e.summary, e.published, e.timestamp'
+        if self.fts:
+            query = ' '.join('"%s"*' % word.replace('"', '""') for word in words)
+            rows = self.db.execute('SELECT %s FROM entries_fts JOIN entries e ON e.rowid = entries_fts.rowid '
+                                   'WHERE entries_fts MATCH ? ORDER BY rank LIMIT ?' % columns, (query, limit))
+        else:
+            conditions = ' AND '.join(['(e.title LIKE ? OR e.summary LIKE ?)'] * len(words))
+            params = [pattern for word in words for pattern in ('%' + word + '%',) * 2]
+            rows = self.db.execute('SELECT %s FROM entries e WHERE %s ORDER BY e.timestamp DESC LIMIT ?' % (columns, conditions),
+                                   params + [limit])
+
+        return [(url, Entry(item_id, title, link, summary, published, timestamp))
+                for (url, item_id, title, link, summary, published, timestamp) in rows]
+
+class ReadState(object):
+    def __init__(self, path=READ_STATE_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS read_items ('
+                            'url TEXT NOT NULL, item_id TEXT NOT NULL, last_seen INTEGER NOT NULL DEFAULT 0, '
+                            'PRIMARY KEY (url, item_id)) WITHOUT ROWID')
+
+            columns = [row[1] for row in self.db.execute('PRAGMA table_info(read_items)')]
+            if 'last_seen' not in columns:
+                self.db.execute('ALTER TABLE read_items ADD COLUMN last_seen INTEGER NOT NULL DEFAULT 0')
+                self.db.execute('UPDATE read_items SET last_seen = ?', (int(time.time()),))
+
+    # one-time import of the json blob that used to live in the already-read key
+    def migrate(self, settings):
+        try:
+            read_ids = json.loads(settings.get_string('already-read'))
+        except ValueError:
+            read_ids = {}
+
+        if read_ids:
+            now = int(time.time())
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO read_items (url, item_id, last_seen) VALUES (?, ?, ?)',
+                                    ((url, item_id, now) for (url, ids) in read_ids.items() for item_id in ids))
+
+        settings.reset('already-read')
+
+    def get_read_ids(self, url):
+        return {row[0] for row in self.db.execute('SELECT item_id FROM read_items WHERE url = ?', (url,))}
+
+    # all ids are written in a single transaction
+    def mark_read(self, url, item_ids):
+        now = int(time.time())
+        with self.db:
+            self.db.executemany('INSERT OR IGNORE INTO read_items (url, item_id, last_seen) VALUES (?, ?, ?)',
+                                ((url, item_id, now) for item_id in item_ids))
+
+    # records that these read ids are still present in the feed; rows are only rewritten once a day
+    def touch(self, url, item_ids):
+        now = int(time.time())
+        with self.db:
+            self.db.executemany('UPDATE read_items SET last_seen = ? WHERE url = ? AND item_id = ? AND last_seen < ?',
+                                ((now, url, item_id, now - COMPACT_INTERVAL) for item_id in item_ids))
+
+    # forgets read ids that have not been seen in their feed for retention_days, except those of the feeds in
+    # keep_urls. Uses its own connection so it can run on a background thread.
+    def compact(self, retention_days, keep_urls=()):
+        cutoff = int(time.time()) - retention_days * 24 * 60 * 60
+        keep_urls = list(keep_urls)
+
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                removed = db.execute('DELETE FROM read_items WHERE last_seen < ? AND url NOT IN (%s)' % ', '.join('?' * len(keep_urls)),
+                                     [cutoff] + keep_urls).rowcount
+            if removed:
+                db.execute('VACUUM')
+        finally:
+            db.close()
+
+        return removed
+
+# A fixed set of daemon threads running submitted jobs. Unlike a ThreadPoolExecutor, whose threads are joined
+# at exit, quitting never waits for a request that is still waiting on a slow server.
+class WorkerPool(object):
+    def __init__(self, workers, name):
+        self.jobs = queue.SimpleQueue()
+        self.threads = [threading.Thread(target=self._work, name='%s_%d' % (name, i), daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, func, *args):
+        self.jobs.put((func, args))
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+
+            (func, args) = job
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    # drops the jobs that haven't started, running ones are left to finish or die with the process
+    def shutdown(self):
+        try:
+            while True:
+                self.jobs.get_nowait()
+        except queue.Empty:
+            pass
+
+        for thread in self.threads:
+            self.jobs.put(None)
+
+# dispatch(func, *args) has to call func(*args) on the thread that owns the callbacks, GLib.idle_add does
+# that for the applet. Without it callbacks run on the worker threads.
+class FetchPool(object):
+    def __init__(self, workers=8, per_host=2, connect_timeout=10, read_timeout=30, dispatch=None):
+        self.dispatch = dispatch or (lambda func, *args: func(*args))
+        self.executor = WorkerPool(workers, 'feed-fetch')
+        self.per_host = per_host
+        self.timeout = (connect_timeout, read_timeout)
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.active = {}
+        self.cancelled = threading.Event()
+
+    # job(timeout) runs on a worker thread, callback(result) through dispatch
+    def submit(self, url, job, callback):
+        host = urllib.parse.urlsplit(url).hostname
+
+        with self.lock:
+            if self.cancelled.is_set():
+                return
+
+            self.queues.setdefault(host, collections.deque()).append((job, callback))
+            self._dispatch(host)
+
+    # only called with self.lock held
+    def _dispatch(self, host):
+        queue = self.queues.get(host)
+        while queue and self.active.get(host, 0) < self.per_host:
+            (job, callback) = queue.popleft()
+            self.active[host] = self.active.get(host, 0) + 1
+            self.executor.submit(self._run, host, job, callback)
+
+        if not queue:
+            self.queues.pop(host, None)
+
+    def _run(self, host, job, callback):
+        result = None
+        try:
+            if not self.cancelled.is_set():
+                result = job(self.timeout)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.active[host] -= 1
+                if not self.cancelled.is_set():
+                    self._dispatch(host)
+
+        if not self.cancelled.is_set():
+            self.dispatch(self._deliver, callback, result)
+
+    def _deliver(self, callback, result):
+        if not self.cancelled.is_set():
+            callback(result)
+
+        return False
+
+    def shutdown(self):
+        self.cancelled.set()
+        with self.lock:
+            self.queues.clear()
+        self.executor.shutdown()
+
+# seconds the current thread has spent opening connections, i.e. resolving hosts and connecting, since it
+# last reset seconds. Requests that reuse a kept-alive connection add nothing.
+connect_timer = threading.local()
+
+class TimedConnection(object):
+    def _new_conn(self):
+        start = time.monotonic()
+        try:
+            return super(TimedConnection, self)._new_conn()
+        finally:
+            connect_timer.seconds = getattr(connect_timer, 'seconds', 0) + time.monotonic() - start
+
+class TimedHTTPConnection(TimedConnection, HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(TimedConnection, HTTPSConnection):
+    pass
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+# an HTTPAdapter whose connections record how long they took to open in connect_timer
+class TimedAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super(TimedAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+# Shared by all fetch workers so connections to a host are kept alive and reused between feeds and polls.
+# The fetch pool never runs more than per_host requests to one host, so that is all a host's pool needs.
+def create_session(per_host):
+    session = requests.Session()
+    adapter = TimedAdapter(pool_connections=HOST_POOLS, pool_maxsize=per_host)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = ACCEPT_ENCODING
+
+    return session
+
+# Checks that url serves a feed, returning True or an error message. Runs on a fetch worker, and seeds the
+# validators and entry cache so the first real refresh of the feed can be a 304.
+def validate_feed(session, url, timeout, validators, entry_cache):
+    try:
+        response = session.get(url, timeout=timeout)
+    except requests.RequestException as e:
+        return str(e)
+
+    if not response.ok:
+        return 'status %d' % response.status_code
+
+    body = response.content
+    try:
+        entries = parse_feed_stream(body)[0]
+    except ValueError:
+        parsed = feedparser.parse(body, response_headers=dict(response.headers))
+        if parsed.bozo and not parsed.entries:
+            return 'not a feed'
+        entries = parsed.entries
+
+    validators.update(url, response.headers, body)
+    entry_cache.save(url, entries)
+
+    return True
+
+
+# the url's own extension if it matches the content type, so the cached copy opens with the right application
+def get_extension(url, content_type):
+    content_type = content_type.partition(';')[0].strip().lower()
+    extension = os.path.splitext(urllib.parse.urlsplit(url).path)[1].lower()
+    if extension and mimetypes.guess_type('file' + extension)[0] == content_type:
+        return extension
+
+    return mimetypes.guess_extension(content_type) or extension[:8]
+
+# downloaded articles and enclosures, capped at max_size bytes. Files are named after the sha1 of their
+# url, and the least recently opened or downloaded ones are evicted first.
+class ArticleCache(object):
+    def __init__(self, path=ARTICLE_CACHE_DIR, max_size=200 * 1024 * 1024):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.files = collections.OrderedDict()
+
+        cached = []
+        for entry in os.scandir(path):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                cached.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for (mtime, name, size) in sorted(cached):
+            self.files[os.path.splitext(name)[0]] = (name, size)
+        self.size = sum(size for (name, size) in self.files.values())
+
+    def _get_key(self, url):
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def has(self, url):
+        with self.lock:
+            return self._get_key(url) in self.files
+
+    # returns the path of the cached copy of url, or None
+    def get(self, url):
+        key = self._get_key(url)
+        with self.lock:
+            if key not in self.files:
+                return None
+
+            self.files.move_to_end(key)
+            path = os.path.join(self.path, self.files[key][0])
+
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+
+        return path
+
+    # moves a finished download from tmp_path into the cache
+    def add(self, url, tmp_path, extension):
+        key = self._get_key(url)
+        name = key + extension
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, os.path.join(self.path, name))
+
+        with self.lock:
+            if key in self.files:
+                (old_name, old_size) = self.files.pop(key)
+                self.size -= old_size
+                if old_name != name:
+                    self._remove(old_name)
+
+            self.files[key] = (name, size)
+            self.size += size
+            self._evict()
+
+    def set_max_size(self, max_size):
+        with self.lock:
+            self.max_size = max_size
+            self._evict()
+
+    # only called with self.lock held
+    def _evict(self):
+        while self.size > self.max_size and self.files:
+            (name, size) = self.files.popitem(last=False)[1]
+            self.size -= size
+            self._remove(name)
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.path, name))
+        except FileNotFoundError:
+            pass
+
+# spreads downloads out so they add up to at most rate bytes per second, 0 means no limit
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.next_time = time.monotonic()
+
+    def consume(self, amount):
+        if self.rate <= 0:
+            return
+
+        with self.lock:
+            now = time.monotonic()
+            self.next_time = max(self.next_time, now) + amount / self.rate
+            delay = self.next_time - now
+
+        time.sleep(delay)
+
+# downloads the articles, and optionally the enclosures, of entries into an ArticleCache in the background.
+# Uses its own session and workers so it never holds up feed refreshes.
+class Prefetcher(object):
+    def __init__(self, cache, concurrency=2, bandwidth=0, enclosures=False, timeout=(10, 30), callback=None, dispatch=None):
+        self.cache = cache
+        self.enclosures = enclosures
+        self.timeout = timeout
+        self.callback = callback
+        self.dispatch = dispatch or (lambda func, *args: func(*args))
+        self.session = create_session(concurrency)
+        self.executor = WorkerPool(concurrency, 'feed-prefetch')
+        self.limiter = RateLimiter(bandwidth)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.cancelled = threading.Event()
+
+    def prefetch(self, entries):
+        for entry in entries:
+            urls = [entry.link] + list(entry.enclosures if self.enclosures else ())
+            for url in urls:
+                if not url.startswith(('http://', 'https://')) or self.cache.has(url):
+                    continue
+
+                with self.lock:
+                    if self.cancelled.is_set() or url in self.pending:
+                        continue
+                    self.pending.add(url)
+
+                self.executor.submit(self._download, url)
+
+    def _download(self, url):
+        tmp_path = None
+        try:
+            if self.cancelled.is_set():
+                return
+
+            with self.session.get(url, stream=True, timeout=self.timeout) as response:
+                if not response.ok:
+                    return
+
+                # anything that wouldn't fit in half the cache would just evict everything else
+                max_size = self.cache.max_size // 2
+                if int(response.headers.get('Content-Length') or 0) > max_size:
+                    return
+
+                extension = get_extension(url, response.headers.get('Content-Type', ''))
+
+                (fd, tmp_path) = tempfile.mkstemp(suffix='.tmp', dir=self.cache.path)
+                size = 0
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in response.iter_content(PREFETCH_CHUNK_SIZE):
+                        if self.cancelled.is_set():
+                            return
+                        size += len(chunk)
+                        if size > max_size:
+                            return
+                        self.limiter.consume(len(chunk))
+                        f.write(chunk)
+
+            self.cache.add(url, tmp_path, extension)
+            tmp_path = None
+
+            if self.callback is not None and not self.cancelled.is_set():
+                self.dispatch(self._deliver, url)
+        except (requests.RequestException, OSError) as e:
+            print('error prefetching %s: %s' % (url, e), file=sys.stderr)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            with self.lock:
+                self.pending.discard(url)
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+
+    def _deliver(self, url):
+        if not self.cancelled.is_set():
+            self.callback(url)
+
+        return False
+
+    def shutdown(self):
+        self.cancelled.set()
+        self.session.close()
+        self.executor.shutdown()
+
+# one subscription: fetching and parsing it, its read ids and when it should be polled next
+class FeedSource(object):
+    def __init__(self, engine, name, url):
+        self.engine = engine
+        self.name = name
+        self.url = url
+        self.read_ids = engine.read_state.get_read_ids(url)
+
+        self.max_entries = 0
+        self.stop_after = 0
+
+        self.poll_interval = TIMEOUT
+        self.feed_period = None
+        self.errors = 0
+
+        self.fetch_count = 0
+        self.error_count = 0
+        self.history = collections.deque(maxlen=DIAGNOSTICS_WINDOW)
+
+    def _load_cached(self, timeout, lifetime, status, details):
+        start = time.monotonic()
+        entries = self.engine.entry_cache.load(self.url)
+        if entries is None:
+            return self.fetch(False, False, timeout)
+        details['timings']['parse'] = time.monotonic() - start
+
+        return FetchResult(entries, False, False, lifetime, None, status, **details)
+
+    # runs on a fetch worker. Validators are only sent when there is something to show for a 304, either
+    # entries already loaded by the caller or the on-disk cache.
+    def fetch(self, conditional, loaded, timeout, known_ids=frozenset()):
+        validators = self.engine.validators
+        headers = validators.get_headers(self.url) if conditional else {}
+        details = {'timings': {}, 'code': None, 'size': 0, 'message': None}
+        timings = details['timings']
+
+        connect_timer.seconds = 0
+        start = time.monotonic()
+        try:
+            response = self.engine.session.get(self.url, headers=headers, timeout=timeout)
+        except requests.RequestException as e:
+            print('error fetching %s: %s' % (self.url, e), file=sys.stderr)
+            details['message'] = str(e)
+            timings['connect'] = connect_timer.seconds
+            return FetchResult(None, False, True, None, None, 'error', **details)
+
+        # elapsed runs from sending the request until the headers are parsed, which includes resolving and
+        # connecting when there was no idle connection to reuse. Redirects may have opened more than one.
+        timings['connect'] = connect_timer.seconds
+        timings['wait'] = max(0, response.elapsed.total_seconds() - timings['connect'])
+        timings['transfer'] = max(0, time.monotonic() - start - timings['connect'] - timings['wait'])
+        details['code'] = response.status_code
+        details['size'] = len(response.content)
+
+        lifetime = get_lifetime(response)
+
+        if response.status_code == 304:
+            validators.record_not_modified(self.url)
+            if not loaded:
+                return self._load_cached(timeout, lifetime, 'not-modified', details)
+            return FetchResult(None, False, False, lifetime, None, 'not-modified', **details)
+
+        if not response.ok:
+            print('error fetching %s: status %d' % (self.url, response.status_code), file=sys.stderr)
+            details['message'] = 'status %d' % response.status_code
+            return FetchResult(None, False, True, lifetime, None, 'error', **details)
+
+        body = response.content
+        changed = validators.update(self.url, response.headers, body)
+        if conditional and not changed:
+            if not loaded:
+                return self._load_cached(timeout, lifetime, 'unchanged', details)
+            return FetchResult(None, False, False, lifetime, None, 'unchanged', **details)
+
+        start = time.monotonic()
+        (entries, feed_info) = self._parse_body(body, response.headers, known_ids)
+        self.engine.entry_cache.save(self.url, entries)
+        entries = [Entry.from_info(info) for info in entries]
+        timings['parse'] = time.monotonic() - start
+
+        return FetchResult(entries, True, False, lifetime, get_feed_period(feed_info), 'fetched', **details)
+
+    def _parse_body(self, body, headers, known_ids):
+        max_entries = self.max_entries
+        stop_after = self.stop_after
+
+        try:
+            (entries, feed_info, complete) = parse_feed_stream(body, known_ids, stop_after, max_entries)
+        except ValueError:
+            parsed = feedparser.parse(body, response_headers=dict(headers))
+            entries = parsed['entries'][:max_entries] if max_entries > 0 else parsed['entries']
+            return (entries, parsed['feed'])
+
+        if complete:
+            return (entries, feed_info)
+
+        # The rest of the feed is already known, so take it from the cache rather than parsing it again: what
+        # followed the last known entry last time, cut to the number of entries in the body so the ones that
+        # fell off the end of the feed drop out. Without that entry in the cache there is no telling what the
+        # rest is, and the whole feed is parsed after all.
+        cached = self.engine.entry_cache.load_raw(self.url) or []
+        last_id = entries[-1]['id']
+        position = next((i for (i, entry) in enumerate(cached) if entry['id'] == last_id), None)
+        length = len(ENTRY_END_PATTERN.findall(body))
+        if max_entries > 0:
+            length = min(length, max_entries)
+        if position is None or length < len(entries):
+            (entries, feed_info, complete) = parse_feed_stream(body, max_entries=max_entries)
+            return (entries, feed_info)
+
+        seen = {entry['id'] for entry in entries}
+        entries.extend(entry for entry in cached[position + 1:] if entry['id'] not in seen)
+        del entries[length:]
+
+        return (entries, feed_info)
+
+    # unchanged feeds are polled less and less often, failing ones back off exponentially, and
+    # neither is polled sooner than the server or the feed asked for
+    def get_next_interval(self, result):
+        if result.period is not None:
+            self.feed_period = result.period
+
+        if result.error:
+            self.errors += 1
+            interval = self.poll_interval * 2 ** min(self.errors, MAX_BACKOFF_STEPS)
+        else:
+            self.errors = 0
+            if result.changed:
+                self.poll_interval = TIMEOUT
+            else:
+                self.poll_interval = min(self.poll_interval * 1.5, MAX_POLL_INTERVAL)
+            interval = self.poll_interval
+
+            if self.feed_period is not None:
+                interval = max(interval, self.feed_period)
+
+        if result.lifetime is not None:
+            interval = max(interval, result.lifetime)
+
+        interval = min(max(interval, MIN_POLL_INTERVAL), MAX_POLL_INTERVAL)
+
+        return interval * random.uniform(0.9, 1.1)
+
+    # called on the consumer's thread with the outcome of each fetch, apply_time is how long it took to show it
+    def record(self, result, apply_time=None):
+        timings = dict(result.timings or {}) if result is not None else {}
+        if apply_time is not None:
+            timings['apply'] = apply_time
+
+        self.fetch_count += 1
+        if result is None or result.error:
+            self.error_count += 1
+
+        self.history.append({
+            'time': time.time(),
+            'status': result.status if result is not None else 'error',
+            'code': result.code if result is not None else None,
+            'size': result.size if result is not None else 0,
+            'message': result.message if result is not None else 'unexpected error',
+            'timings': timings
+        })
+
+    # averages and maxima in milliseconds over the recorded fetches, plus the fetches themselves
+    def get_diagnostics(self):
+        history = list(self.history)
+        steps = collections.defaultdict(list)
+        for record in history:
+            for (step, seconds) in record['timings'].items():
+                steps[step].append(seconds)
+
+        return {
+            'name': self.name,
+            'url': self.url,
+            'fetches': self.fetch_count,
+            'errors': self.error_count,
+            'average_ms': {step: round(sum(values) / len(values) * 1000, 1) for (step, values) in steps.items()},
+            'max_ms': {step: round(max(values) * 1000, 1) for (step, values) in steps.items()},
+            'history': history
+        }
+
+    # the full summary of an entry that only carries the preview. Entries that have dropped out of the feed,
+    # like old search results, are only in the search index.
+    def load_summary(self, item_id):
+        summary = self.engine.entry_cache.load_summary(self.url, item_id)
+        if summary is None:
+            summary = self.engine.search_index.load_summary(self.url, item_id)
+
+        return summary
+
+    def is_read(self, item_id):
+        return item_id in self.read_ids
+
+    def mark_read(self, item_ids):
+        self.engine.read_state.mark_read(self.url, item_ids)
+        self.read_ids.update(item_ids)
+
+    # entries is the full list of entries currently in the feed, added the ones that weren't before
+    def apply(self, entries, added):
+        summaries = {}
+        if any(entry.summary_truncated for entry in added):
+            summaries = {info['id']: info['summary'] for info in self.engine.entry_cache.load_raw(self.url) or []}
+        self.engine.search_index.add(self.url, added, summaries)
+        self.touch(entry.id for entry in entries)
+
+    # keeps the read state of these ids, which are still in the feed, from being compacted away. Has to be
+    # called after every successful fetch, including ones where the feed didn't change.
+    def touch(self, item_ids):
+        self.engine.read_state.touch(self.url, set(item_ids) & self.read_ids)
+
+    def has_failed(self):
+        return not self.history or self.history[-1]['status'] == 'error'
+
+    def reload_read_ids(self):
+        self.read_ids = self.engine.read_state.get_read_ids(self.url)
+
+class FeedEngine(object):
+    def __init__(self, workers=8, per_host=2, connect_timeout=10, read_timeout=30, max_entries=0, stop_after=0, dispatch=None):
+        self.validators = ValidatorStore()
+        self.entry_cache = EntryCache()
+        self.search_index = SearchIndex()
+        self.read_state = ReadState()
+        self.fetch_pool = FetchPool(workers, per_host, connect_timeout, read_timeout, dispatch)
+        self.session = create_session(per_host)
+        self.article_cache = ArticleCache()
+        self.dispatch = dispatch
+        self.prefetcher = None
+
+        self.max_entries = max_entries
+        self.stop_after = stop_after
+
+    # callback(result) gets a FetchResult, or None if the fetch raised
+    def refresh(self, source, callback, loaded=False, known_ids=frozenset()):
+        conditional = loaded or self.entry_cache.has(source.url)
+        source.max_entries = self.max_entries
+        source.stop_after = self.stop_after
+        self.fetch_pool.submit(source.url, lambda timeout: source.fetch(conditional, loaded, timeout, known_ids), callback)
+
+    # callback(result) gets True or an error message, see validate_feed
+    def validate(self, url, callback):
+        self.fetch_pool.submit(url, lambda timeout: validate_feed(self.session, url, timeout, self.validators, self.entry_cache), callback)
+
+    # drops everything stored for a feed that was unsubscribed
+    def forget(self, url):
+        self.search_index.remove_feed(url)
+        self.validators.forget(url)
+        self.entry_cache.remove(url)
+
+    # replaces the running prefetcher, if any. callback(url) is called through dispatch whenever a download
+    # has been added to the article cache.
+    def start_prefetcher(self, cache_size, concurrency, bandwidth, enclosures, callback=None):
+        self.stop_prefetcher()
+        self.article_cache.set_max_size(cache_size)
+        self.prefetcher = Prefetcher(self.article_cache, concurrency, bandwidth, enclosures, self.fetch_pool.timeout, callback, self.dispatch)
+
+    def stop_prefetcher(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
+            self.prefetcher = None
+
+    # queues the articles of entries for download if prefetching is on
+    def prefetch(self, entries):
+        if self.prefetcher is not None:
+            self.prefetcher.prefetch(entries)
+
+    def shutdown(self):
+        self.stop_prefetcher()
+        self.session.close()
+        self.fetch_pool.shutdown()
+
+# Refreshes every feed in subscriptions once and returns a report per feed. Blocks until all of them are done.
+def check_feeds(subscriptions, **options):
+    calls = queue.SimpleQueue()
+    engine = FeedEngine(dispatch=lambda func, *args: calls.put((func, args)), **options)
+    report = []
+
+    def on_fetched(result, source, known_ids, start):
+        entries = (result.entries or []) if result is not None else []
+        added = [entry for entry in entries if entry.id not in known_ids]
+        source.apply(entries, added)
+        source.record(result)
+
+        record = source.history[-1]
+        timings = dict(record['timings'], total=time.monotonic() - start)
+        feed_report = {'name': source.name, 'url': source.url, 'status': record['status'], 'code': record['code'],
+                       'size': record['size'], 'message': record['message']}
+        feed_report['timings'] = {step: round(seconds * 1000, 1) for (step, seconds) in timings.items()}
+        feed_report['entries'] = len(entries)
+        feed_report['new'] = len(added)
+        feed_report['unread'] = sum(1 for entry in entries if not source.is_read(entry.id))
+        report.append(feed_report)
+
+    sources = []
+    for (name, url) in subscriptions:
+        if all(source.url != url for source in sources):
+            sources.append(FeedSource(engine, name, url))
+
+    try:
+        for source in sources:
+            known_ids = frozenset(entry['id'] for entry in engine.entry_cache.load_raw(source.url) or [])
+            engine.refresh(source, lambda result, source=source, known_ids=known_ids, start=time.monotonic():
+                           on_fetched(result, source, known_ids, start), known_ids=known_ids)
+
+        while len(report) < len(sources):
+            (func, args) = calls.get()
+            func(*args)
+    finally:
+        engine.shutdown()
+
+    urls = [source.url for source in sources]
+    report.sort(key=lambda feed_report: urls.index(feed_report['url']))
+
+    return (report, dict(engine.validators.stats))
+
+def get_subscriptions():
+    from gi.repository import Gio
+
+    settings = Gio.Settings(schema_id=SCHEMA)
+    options = {
+        'workers': settings.get_int('fetch-workers'),
+        'per_host': settings.get_int('fetch-per-host'),
+        'connect_timeout': settings.get_double('connect-timeout'),
+        'read_timeout': settings.get_double('read-timeout'),
+        'max_entries': settings.get_int('max-entries'),
+        'stop_after': settings.get_int('known-entries-stop')
+    }
+
+    return (settings.get_value('subscribed-feeds').unpack(), options)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='feeds', description='Checks all subscribed feeds without opening the applet.')
+    parser.add_argument('--check', action='store_true', required=True, help='refresh every subscription and report new and unread items')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    parser.add_argument('--opml', metavar='PATH', help='check the feeds in an OPML file instead of the subscriptions')
+    args = parser.parse_args(argv)
+
+    if args.opml:
+        try:
+            subscriptions = read_opml(args.opml)
+        except (OSError, ET.ParseError) as e:
+            parser.error('could not read %s: %s' % (args.opml, e))
+        options = {}
+    else:
+        (subscriptions, options) = get_subscriptions()
+
+    (report, stats) = check_feeds(subscriptions, **options)
+
+    if args.json:
+        json.dump({'feeds': report, 'stats': stats}, sys.stdout, indent=2)
+        print()
+    else:
+        for feed_report in report:
+            print('%-30s %-12s %4d new %4d unread %8.1f ms' % (feed_report['name'][:30], feed_report['status'], feed_report['new'],
+                                                               feed_report['unread'], feed_report['timings']['total']))
+
+    return 1 if any(feed_report['status'] == 'error' for feed_report in report) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
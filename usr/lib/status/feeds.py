@@ -1,10 +1,14 @@
 #!/usr/bin/python3
 
-import feedparser
+import heapq
 import html
+import itertools
 import json
+import sqlite3
 import threading
+import time
 import traceback
+import xml.etree.ElementTree as ET
 from setproctitle import setproctitle
 
 import gi
@@ -14,9 +18,98 @@ gi.require_version('XApp', '1.0')
 
 from gi.repository import Gdk, Gio, GLib, GObject, Gtk, Pango, XApp
 
+from status.feed_engine import COMPACT_INTERVAL, SCHEMA, FeedEngine, FeedSource, FetchResult, read_opml, write_opml
+
 APPLICATION_ID = 'org.xstatus.feeds'
-SCHEMA = 'org.xstatus.feeds'
-TIMEOUT = 15 * 60
+
+# rows are only built for the viewport plus this many pages above and below it, and torn down again once
+# they are further away than ROW_KEEP_PAGES
+ROW_BUILD_PAGES = 1
+ROW_KEEP_PAGES = 3
+ESTIMATED_ROW_HEIGHT = 100
+
+TIMELINE_PAGE_SIZE = 50
+
+# splices only the inserted and removed runs into the model so existing rows survive a refresh.
+# old_items must match the current contents of model.
+def reconcile_model(model, old_items, new_items):
+    old_set = set(old_items)
+    new_set = set(new_items)
+
+    if [item for item in old_items if item in new_set] != [item for item in new_items if item in old_set]:
+        model.splice(0, len(old_items), new_items)
+        return
+
+    i = len(old_items) - 1
+    while i >= 0:
+        if old_items[i] in new_set:
+            i -= 1
+            continue
+
+        end = i
+        while i >= 0 and old_items[i] not in new_set:
+            i -= 1
+        model.splice(i + 1, end - i, [])
+
+    position = 0
+    i = 0
+    while i < len(new_items):
+        if new_items[i] in old_set:
+            position += 1
+            i += 1
+            continue
+
+        start = i
+        while i < len(new_items) and new_items[i] not in old_set:
+            i += 1
+        model.splice(position, 0, new_items[start:i])
+        position += i - start
+
+class PollScheduler(object):
+    def __init__(self, callback):
+        self.callback = callback
+        self.queue = []
+        self.due = {}
+        self.counter = itertools.count()
+        self.source_id = 0
+
+    def schedule(self, feed, delay):
+        due = time.monotonic() + delay
+        self.due[feed] = due
+        heapq.heappush(self.queue, (due, next(self.counter), feed))
+        self._update_timeout()
+
+    def remove(self, feed):
+        self.due.pop(feed, None)
+
+    # entries that were rescheduled or removed are left in the heap and skipped here
+    def _update_timeout(self):
+        while self.queue and self.due.get(self.queue[0][2]) != self.queue[0][0]:
+            heapq.heappop(self.queue)
+
+        if self.source_id:
+            GLib.source_remove(self.source_id)
+            self.source_id = 0
+
+        if self.queue:
+            delay = max(0, self.queue[0][0] - time.monotonic())
+            self.source_id = GLib.timeout_add_seconds(int(delay) + 1, self._on_timeout)
+
+    def _on_timeout(self):
+        self.source_id = 0
+
+        now = time.monotonic()
+        while self.queue and self.queue[0][0] <= now:
+            (due, i, feed) = heapq.heappop(self.queue)
+            if self.due.get(feed) != due:
+                continue
+
+            del self.due[feed]
+            self.callback(feed)
+
+        self._update_timeout()
+
+        return GLib.SOURCE_REMOVE
 
 class FeedItem(GObject.Object):
     @GObject.Signal(flags=GObject.SignalFlags.RUN_LAST, return_type=bool,
@@ -25,28 +118,106 @@ class FeedItem(GObject.Object):
     def marked_read(self, item_id):
         pass
 
-    def __init__(self, info, unread):
+    def __init__(self, feed, entry, unread):
         super(FeedItem, self).__init__()
-        self.info = info
-        self.title = info.title
-        self.link = info.link
-        self.item_id = info.id
+        self.feed = feed
+        self.entry = entry
         self.unread = unread
-        if 'description' in info and info.description != '':
-            self.description = info.description
-        elif 'summary' in info and info.summary != '':
-            self.description = info.summary
-        else:
-            self.description = None
+        self.rows = []
+
+    @property
+    def item_id(self):
+        return self.entry.id
+
+    @property
+    def title(self):
+        return self.entry.title
+
+    @property
+    def link(self):
+        return self.entry.link
 
-        self.published = info.published
+    @property
+    def description(self):
+        return self.entry.summary or None
 
+    @property
+    def published(self):
+        return self.entry.published
+
+    # an item has one row per list it is shown in, i.e. its feed's page and the timeline
     def create_widget(self):
-        row = Gtk.ListBoxRow()
-        row.item = self
+        row = FeedRow(self)
+        self.rows.append(row)
+        row.connect('destroy', lambda row: self.rows.remove(row))
+
+        return row
+
+    def load_full_summary(self):
+        if not self.entry.summary_truncated:
+            return self.entry.summary
+
+        return self.feed.source.load_summary(self.item_id)
+
+    def launch(self, *args):
+        self.mark_read()
+        Gtk.show_uri(None, self.link, Gdk.CURRENT_TIME)
+
+    def has_cached_copy(self):
+        return self.feed.engine.article_cache.has(self.link)
+
+    # opens the prefetched copy of the article, or the article itself if it has been evicted since
+    def launch_cached(self, *args):
+        path = self.feed.engine.article_cache.get(self.link)
+        if path is None:
+            self.launch()
+            return
+
+        self.mark_read()
+        Gtk.show_uri(None, GLib.filename_to_uri(path), Gdk.CURRENT_TIME)
+
+    def mark_read(self, *args):
+        if not self.unread:
+            return
+
+        self.set_read()
+        self.emit('marked-read', self.item_id)
+
+    # updates the item without emitting marked-read, for callers that persist read state themselves
+    def set_read(self):
+        self.unread = False
+        self.update_marker()
+
+    def update_marker(self):
+        for row in self.rows:
+            row.update_marker()
+
+    def update_cached(self):
+        for row in self.rows:
+            row.update_cached()
+
+# an empty placeholder until it scrolls near the viewport, see FeedList.update_rows
+class FeedRow(Gtk.ListBoxRow):
+    def __init__(self, item):
+        super(FeedRow, self).__init__(height_request=ESTIMATED_ROW_HEIGHT, visible=True)
+        self.item = item
+        self.built = False
+        self.expanded = False
+        self.unread_marker_style_manager = None
+        self.description_label = None
+        self.cached_button = None
+
+        self.set_tooltip_text(html.escape(item.title))
+
+    def build(self):
+        if self.built:
+            return
+
+        self.built = True
+        self.set_size_request(-1, -1)
 
         main_box = Gtk.Box(spacing=5, margin_top=10, margin_bottom=5, margin_left=10, margin_right=10)
-        row.add(main_box)
+        self.add(main_box)
 
         unread_marker = Gtk.Separator(orientation=Gtk.Orientation.VERTICAL, width_request=4)
         main_box.pack_start(unread_marker, False, False, 0)
@@ -56,58 +227,221 @@ class FeedItem(GObject.Object):
         v_box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=5)
         main_box.pack_start(v_box, False, False, 0)
 
-        title = Gtk.Label(label='<span size="larger" weight="bold">%s</span>' % html.escape(self.title), use_markup=True, ellipsize=Pango.EllipsizeMode.END, halign=Gtk.Align.START)
+        title = Gtk.Label(label='<span size="larger" weight="bold">%s</span>' % html.escape(self.item.title), use_markup=True, ellipsize=Pango.EllipsizeMode.END, halign=Gtk.Align.START)
         v_box.pack_start(title, False, False, 0)
 
-        published = Gtk.Label(label='<span size="smaller" style="italic">Published: %s</span>' % self.published, use_markup=True, halign=Gtk.Align.START)
+        published = Gtk.Label(label='<span size="smaller" style="italic">Published: %s</span>' % self.item.published, use_markup=True, halign=Gtk.Align.START)
         v_box.pack_start(published, False, False, 0)
 
-        if self.description:
-            description = Gtk.Label(label=self.description, wrap=True, lines=3, ellipsize=Pango.EllipsizeMode.END, justify=Gtk.Justification.FILL, halign=Gtk.Align.START)
-            v_box.pack_start(description, False, False, 0)
+        if self.item.description:
+            self.description_label = Gtk.Label(label=self.item.description, wrap=True, lines=3, ellipsize=Pango.EllipsizeMode.END, justify=Gtk.Justification.FILL, halign=Gtk.Align.START)
+            v_box.pack_start(self.description_label, False, False, 0)
 
         launch_button = Gtk.Button.new_from_icon_name('player_start', Gtk.IconSize.LARGE_TOOLBAR)
         launch_button.set_valign(Gtk.Align.CENTER)
-        launch_button.connect('clicked', self.launch)
+        launch_button.connect('clicked', self.item.launch)
         main_box.pack_end(launch_button, False, False, 0)
 
-        row.set_tooltip_text(html.escape(self.title))
+        self.cached_button = Gtk.Button.new_from_icon_name('document-open-symbolic', Gtk.IconSize.LARGE_TOOLBAR)
+        self.cached_button.set_valign(Gtk.Align.CENTER)
+        self.cached_button.set_tooltip_text('Open cached copy')
+        self.cached_button.set_no_show_all(True)
+        self.cached_button.connect('clicked', self.item.launch_cached)
+        main_box.pack_end(self.cached_button, False, False, 0)
+        self.update_cached()
 
-        row.show_all()
+        main_box.show_all()
 
-        return row
+    # keeps the measured height so the scrollbar doesn't jump
+    def unbuild(self):
+        if not self.built:
+            return
 
-    def launch(self, *args):
-        self.mark_read()
-        Gtk.show_uri(None, self.link, Gdk.CURRENT_TIME)
+        self.built = False
+        self.expanded = False
+        self.set_size_request(-1, self.get_allocated_height())
+        self.unread_marker_style_manager = None
+        self.description_label = None
+        self.cached_button = None
+        self.get_child().destroy()
+
+    # summary is the full text when expanding an item whose preview was truncated
+    def set_expanded(self, expanded, summary=None):
+        if self.description_label is None:
+            return
 
-    def mark_read(self, *args):
-        if not self.unread:
+        self.expanded = expanded
+        if expanded:
+            self.description_label.set_label(summary or self.item.description)
+            self.description_label.set_lines(-1)
+            self.description_label.set_ellipsize(Pango.EllipsizeMode.NONE)
+        else:
+            self.description_label.set_label(self.item.description)
+            self.description_label.set_lines(3)
+            self.description_label.set_ellipsize(Pango.EllipsizeMode.END)
+
+    def update_cached(self):
+        if self.cached_button is None:
             return
 
-        self.unread = False
-        self.update_marker()
-        self.emit('marked-read', self.item_id)
+        self.cached_button.set_visible(self.item.has_cached_copy())
 
     def update_marker(self):
-        if self.unread:
+        if self.unread_marker_style_manager is None:
+            return
+
+        if self.item.unread:
             self.unread_marker_style_manager.set_style_property('background-color', 'rgba(150, 200, 255, .75)')
         else:
             self.unread_marker_style_manager.set_style_property('background-color', 'rgba(150, 200, 255, 0)')
 
+# a scrolled list of feed items whose rows are only built near the viewport
+class FeedList(Gtk.ScrolledWindow):
+    def __init__(self, model):
+        super(FeedList, self).__init__(hscrollbar_policy=Gtk.PolicyType.NEVER)
+        self.model = model
+
+        self.adjustment = self.get_vadjustment()
+        self.adjustment.connect('value-changed', self.queue_update_rows)
+        self.adjustment.connect('changed', self.queue_update_rows)
+        self.built_rows = set()
+        self.update_rows_id = 0
+
+        self.list_box = Gtk.ListBox(visible=True)
+        self.add(self.list_box)
+
+        self.list_box.bind_model(self.model, lambda item: item.create_widget())
+        self.model.connect('items-changed', self.queue_update_rows)
+        self.list_box.connect('size-allocate', self.queue_update_rows)
+        self.list_box.connect('row-activated', self.on_row_activated)
+
+    def queue_update_rows(self, *args):
+        if not self.update_rows_id:
+            self.update_rows_id = GLib.idle_add(self.update_rows)
+
+    def on_row_activated(self, list_box, row):
+        if not row.built:
+            return
+
+        summary = None if row.expanded else row.item.load_full_summary()
+        row.set_expanded(not row.expanded, summary)
+
+    # builds the rows in and around the viewport and tears down the ones that have scrolled far away
+    def update_rows(self):
+        self.update_rows_id = 0
+
+        page_size = self.adjustment.get_page_size()
+        top = self.adjustment.get_value()
+        build_start = top - page_size * ROW_BUILD_PAGES
+        build_end = top + page_size * (ROW_BUILD_PAGES + 1)
+        keep_start = top - page_size * ROW_KEEP_PAGES
+        keep_end = top + page_size * (ROW_KEEP_PAGES + 1)
+
+        row = self.list_box.get_row_at_y(max(0, int(build_start)))
+        index = row.get_index() if row is not None else 0
+        while True:
+            row = self.list_box.get_row_at_index(index)
+            if row is None:
+                break
+
+            # not laid out yet, size-allocate will queue another pass
+            allocation = row.get_allocation()
+            if allocation.height <= 1 or allocation.y > build_end:
+                break
+
+            row.build()
+            self.built_rows.add(row)
+            index += 1
+
+        for row in list(self.built_rows):
+            allocation = row.get_allocation()
+            if row.get_parent() is None:
+                self.built_rows.discard(row)
+            elif allocation.y + allocation.height < keep_start or allocation.y > keep_end:
+                row.unbuild()
+                self.built_rows.discard(row)
+
+        return GLib.SOURCE_REMOVE
+
+# all items of all feeds, newest first. Only as many items as have been scrolled into view are pulled
+# from a lazy merge of the feeds' sorted lists.
+class Timeline(object):
+    def __init__(self):
+        self.handlers = {}
+        self.items = []
+        self.merge = None
+        self.visible = False
+        self.refresh_id = 0
+
+        self.model = Gio.ListStore(item_type=FeedItem)
+        self.page = FeedList(self.model)
+        self.page.connect('edge-reached', self.on_edge_reached)
+        self.page.show_all()
+
+    def add_feed(self, feed):
+        self.handlers[feed] = feed.model.connect('items-changed', self.queue_refresh)
+        self.queue_refresh()
+
+    def remove_feed(self, feed):
+        feed.model.disconnect(self.handlers.pop(feed))
+        self.queue_refresh()
+
+    def set_visible(self, visible):
+        self.visible = visible
+        if visible:
+            for feed in self.handlers:
+                feed.ensure_loaded()
+            self.queue_refresh()
+
+    def queue_refresh(self, *args):
+        if self.visible and not self.refresh_id:
+            self.refresh_id = GLib.idle_add(self.refresh)
+
+    def refresh(self):
+        self.refresh_id = 0
+
+        self.merge = heapq.merge(*(feed.get_sorted_items() for feed in self.handlers),
+                                 key=lambda item: item.entry.timestamp or 0, reverse=True)
+        new_items = list(itertools.islice(self.merge, max(len(self.items), TIMELINE_PAGE_SIZE)))
+        reconcile_model(self.model, self.items, new_items)
+        self.items = new_items
+
+        return GLib.SOURCE_REMOVE
+
+    def on_edge_reached(self, scrolled_window, position):
+        if position != Gtk.PositionType.BOTTOM or self.merge is None:
+            return
+
+        items = list(itertools.islice(self.merge, TIMELINE_PAGE_SIZE))
+        if items:
+            self.model.splice(len(self.items), 0, items)
+            self.items.extend(items)
+
 class Feed(GObject.Object):
     @GObject.Signal(flags=GObject.SignalFlags.RUN_LAST, return_type=bool,
                     accumulator=GObject.signal_accumulator_true_handled)
     def unread_changed(self):
         pass
 
-    def __init__(self, settings, name, url, read_ids=[]):
+    @GObject.Signal(flags=GObject.SignalFlags.RUN_LAST, return_type=bool,
+                    arg_types=(float,),
+                    accumulator=GObject.signal_accumulator_true_handled)
+    def fetched(self, next_interval):
+        pass
+
+    def __init__(self, engine, name, url):
         super(Feed, self).__init__()
-        self.settings = settings
+        self.engine = engine
+        self.source = FeedSource(engine, name, url)
         self.name = name
         self.url = url
-        self.read_ids = read_ids
         self.items = []
+        self.items_by_id = {}
+
+        self.loaded = False
+        self.fetching = False
+        # set once the feed is unsubscribed, a fetch still running for it is thrown away
+        self.dropped = False
 
         self.has_unread = False
 
@@ -124,54 +458,113 @@ class Feed(GObject.Object):
         toolbar.add(button)
         button.connect('clicked', self.check_for_updates)
 
-        scrolled_window = Gtk.ScrolledWindow(hscrollbar_policy=Gtk.PolicyType.NEVER)
-        self.page.pack_start(scrolled_window, True, True, 0)
-
-        self.list_box = Gtk.ListBox(visible=True)
         self.model = Gio.ListStore(item_type=FeedItem)
-        scrolled_window.add(self.list_box)
-
-        def create_widget(item):
-            widget = item.create_widget()
-            item.connect('marked-read', self.on_child_marked_read)
-
-            return widget
+        self.page.pack_start(FeedList(self.model), True, True, 0)
 
         self.page.show_all()
 
-        self.list_box.bind_model(self.model, create_widget)
+        self.sorted_items = None
 
         # self.check_for_updates()
 
     def check_for_updates(self, *args):
-        thread = threading.Thread(target=self._fetch_url)
-        thread.start()
+        if self.fetching or self.dropped:
+            return
 
-    def _fetch_url(self):
-        a = feedparser.parse(self.url) # move this to thread
-        GLib.idle_add(self._parse_url, a)
+        self.fetching = True
+        known_ids = frozenset(item.item_id for item in self.items)
+        self.engine.refresh(self.source, self._on_fetched, self.loaded, known_ids)
 
-    def _parse_url(self, parser):
-        self.has_unread = False
-        self.items = []
-        self.model.remove_all()
-        for info in parser['entries']:
-            is_unread = info.id not in self.read_ids
-            if is_unread:
-                self.has_unread = True
-            item = FeedItem(info, is_unread)
-            self.model.append(item)
-            self.items.append(item)
+    # fills the page from the on-disk cache the first time it is shown
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+
+        entries = self.engine.entry_cache.load(self.url)
+        if entries is not None:
+            self._parse_url(entries)
 
-        if self.has_unread:
+    def _on_fetched(self, result):
+        self.fetching = False
+        if self.dropped:
+            # the fetch may have written the validators and entry cache again after they were forgotten
+            self.engine.forget(self.url)
+            return
+
+        if result is None:
+            result = FetchResult(None, False, True, None, None, message='unexpected error')
+
+        apply_time = None
+        try:
+            if result.entries is not None:
+                start = time.monotonic()
+                self._parse_url(result.entries)
+                apply_time = time.monotonic() - start
+            elif not result.error:
+                # not modified or unchanged, so everything listed is still in the feed
+                self.source.touch(self.items_by_id)
+        except Exception as e:
+            # e.g. a database locked by the compaction or by feeds --check, counted as a failed fetch
+            traceback.print_exc()
+            result = result._replace(changed=False, error=True, status='error', message=str(e))
+        finally:
+            # the feed is only polled again once it has been rescheduled
+            self.source.record(result, apply_time)
+            self.emit('fetched', self.source.get_next_interval(result))
+
+    def _parse_url(self, entries):
+        self.loaded = True
+
+        current = self.items_by_id
+        new_items = []
+        added = []
+        seen = set()
+        for entry in entries:
+            if entry.id in seen:
+                continue
+            seen.add(entry.id)
+
+            if entry.id in current:
+                new_items.append(current[entry.id])
+            else:
+                item = self.create_item(entry)
+                new_items.append(item)
+                added.append(entry)
+
+        reconcile_model(self.model, self.items, new_items)
+        self.items = new_items
+        self.items_by_id = {item.item_id: item for item in new_items}
+        self.sorted_items = None
+        self.source.apply(entries, added)
+        self.engine.prefetch(entry for entry in added if not self.source.is_read(entry.id))
+
+        had_unread = self.has_unread
+        self.has_unread = any(item.unread for item in self.items)
+        if self.has_unread or had_unread:
             self.emit('unread-changed')
 
+    def create_item(self, entry):
+        item = FeedItem(self, entry, not self.source.is_read(entry.id))
+        item.connect('marked-read', self.on_child_marked_read)
+
+        return item
+
+    # search results that have since dropped out of the feed get a detached item
+    def get_item(self, entry):
+        if entry.id in self.items_by_id:
+            return self.items_by_id[entry.id]
+
+        return self.create_item(entry)
+
+    # newest first, for the timeline's merge
+    def get_sorted_items(self):
+        if self.sorted_items is None:
+            self.sorted_items = sorted(self.items, key=lambda item: item.entry.timestamp or 0, reverse=True)
+
+        return self.sorted_items
+
     def on_child_marked_read(self, i, item_id):
-        read_ids = json.loads(self.settings.get_string('already-read'))
-        if self.url not in read_ids:
-            read_ids[self.url] = []
-        read_ids[self.url].append(item_id)
-        self.settings.set_string('already-read', json.dumps(read_ids))
+        self.source.mark_read([item_id])
 
         self.has_unread = False
         for item in self.items:
@@ -181,8 +574,18 @@ class Feed(GObject.Object):
         self.emit('unread-changed')
 
     def mark_all_read(self, *args):
-        for item in self.items:
-            item.mark_read()
+        unread = [item for item in self.items if item.unread]
+        if not unread:
+            return
+
+        item_ids = [item.item_id for item in unread]
+        self.source.mark_read(item_ids)
+
+        for item in unread:
+            item.set_read()
+
+        self.has_unread = False
+        self.emit('unread-changed')
 
 class App(Gtk.Application):
     def __init__(self):
@@ -190,6 +593,7 @@ class App(Gtk.Application):
 
         self.has_activated = False
         self.feeds = []
+        self.scheduler = PollScheduler(lambda feed: feed.check_for_updates())
 
     def do_activate(self):
         try:
@@ -202,13 +606,30 @@ class App(Gtk.Application):
 
             self.settings = Gio.Settings(schema_id=SCHEMA)
 
+            self.engine = FeedEngine(workers=self.settings.get_int('fetch-workers'),
+                                     per_host=self.settings.get_int('fetch-per-host'),
+                                     connect_timeout=self.settings.get_double('connect-timeout'),
+                                     read_timeout=self.settings.get_double('read-timeout'),
+                                     dispatch=GLib.idle_add)
+            self.settings.connect('changed::max-entries', self.update_parse_limits)
+            self.settings.connect('changed::known-entries-stop', self.update_parse_limits)
+            self.update_parse_limits()
+
+            for key in ('prefetch-articles', 'prefetch-enclosures', 'prefetch-cache-size', 'prefetch-concurrency', 'prefetch-bandwidth'):
+                self.settings.connect('changed::' + key, self.update_prefetcher)
+            self.update_prefetcher()
+
+            # compacting starts once every feed has been refreshed, see on_feed_fetched
+            self.engine.read_state.migrate(self.settings)
+            self.compacting = False
+
             self.status_icon = XApp.StatusIcon(name='temps')
             self.status_icon.set_icon_name('feeds-symbolic')
 
             self.menu = Gtk.Menu()
 
             item = Gtk.MenuItem(label='Reload', visible=True)
-            item.connect('activate', self.update_feeds)
+            item.connect('activate', self.check_feeds)
             self.menu.append(item)
 
             self.menu.append(Gtk.SeparatorMenuItem())
@@ -226,14 +647,35 @@ class App(Gtk.Application):
             self.add_window(self.window)
 
             self.feed_stack = self.builder.get_object('feed_stack')
+            self.diagnostics_store = self.builder.get_object('diagnostics_store')
+            self.diagnostics_page = self.builder.get_object('diagnostics_page')
+            self.feed_stack.connect('notify::visible-child', self.on_visible_feed_changed)
+
+            self.timeline = Timeline()
+            self.feed_stack.add_titled(self.timeline.page, 'all-items', 'All items')
+
+            self.search_model = Gio.ListStore(item_type=FeedItem)
+            self.search_page = FeedList(self.search_model)
+            self.feed_stack.add_titled(self.search_page, 'search', 'Search results')
+            self.search_page.hide()
+            self.page_before_search = None
+
+            self.builder.get_object('search_entry').connect('search-changed', self.on_search_changed)
+
+            self.feed_stack.add_titled(self.diagnostics_page, 'diagnostics', 'Diagnostics')
+            self.diagnostics_page.hide()
+            self.builder.get_object('save_diagnostics_button').connect('clicked', self.save_diagnostics)
 
             self.builder.get_object('new_feed_item').connect('activate', self.new_feed)
-            self.builder.get_object('refresh_item').connect('activate', self.update_feeds)
+            self.builder.get_object('import_item').connect('activate', self.import_opml)
+            self.builder.get_object('export_item').connect('activate', self.export_opml)
+            self.builder.get_object('diagnostics_item').connect('activate', self.show_diagnostics)
+            self.builder.get_object('refresh_item').connect('activate', self.check_feeds)
             self.builder.get_object('close_item').connect('activate', self.on_window_close)
             self.builder.get_object('quit_item').connect('activate', self.exit)
 
+            self.settings.connect('changed::subscribed-feeds', self.update_feeds)
             self.update_feeds()
-            GLib.timeout_add_seconds(TIMEOUT, self.update_feeds)
 
             self.has_activated = True
 
@@ -243,24 +685,189 @@ class App(Gtk.Application):
             traceback.print_exc()
             self.quit()
 
+    # adds and removes pages for subscriptions that changed, existing feeds are kept as they are
     def update_feeds(self, *args):
-        for feed in self.feeds:
+        current = {feed.url: feed for feed in self.feeds}
+        feeds = []
+        added = []
+        for (name, url) in self.settings.get_value('subscribed-feeds').unpack():
+            if url in current:
+                feed = current.pop(url)
+                if feed.name != name:
+                    feed.name = feed.source.name = name
+                    self.feed_stack.child_set(feed.page, title=name)
+            elif any(feed.url == url for feed in feeds):
+                continue
+            else:
+                feed = Feed(self.engine, name, url)
+                feed.connect('unread-changed', self.on_unread_changed)
+                feed.connect('fetched', self.on_feed_fetched)
+                self.feed_stack.add_titled(feed.page, url, name)
+                self.timeline.add_feed(feed)
+                added.append(feed)
+
+            # the timeline stays on top
+            self.feed_stack.child_set(feed.page, position=len(feeds) + 1)
+            feeds.append(feed)
+
+        for feed in current.values():
+            feed.dropped = True
             self.feed_stack.remove(feed.page)
-        self.feeds = []
-        self.feed_stack.foreach(lambda a: self.feed_stack.remove(a))
+            self.timeline.remove_feed(feed)
+            self.scheduler.remove(feed)
+            self.engine.forget(feed.url)
+
+        self.feeds = feeds
+
+        # the timeline is the stack's first page, but showing it at startup would load every feed rather than
+        # just the visible one
+        if not self.has_activated and feeds:
+            self.feed_stack.set_visible_child(feeds[0].page)
+
+        self.on_visible_feed_changed()
+        self.on_unread_changed()
+        for feed in added:
+            feed.check_for_updates()
+
+    def update_parse_limits(self, *args):
+        self.engine.max_entries = self.settings.get_int('max-entries')
+        self.engine.stop_after = self.settings.get_int('known-entries-stop')
+
+    def update_prefetcher(self, *args):
+        cache_size = self.settings.get_int('prefetch-cache-size') * 1024 * 1024
+        if not self.settings.get_boolean('prefetch-articles'):
+            self.engine.stop_prefetcher()
+            self.engine.article_cache.set_max_size(cache_size)
+            return
 
-        feeds = self.settings.get_value('subscribed-feeds').unpack()
-        for (name, url) in feeds:
-            read_ids = json.loads(self.settings.get_string('already-read'))
-            if url in read_ids:
-                feed = Feed(self.settings, name, url, read_ids[url])
-            else:
-                feed = Feed(self.settings, name, url)
-            feed.connect('unread-changed', self.on_unread_changed)
-            self.feeds.append(feed)
-            self.feed_stack.add_titled(feed.page, name, name)
+        self.engine.start_prefetcher(cache_size, max(1, self.settings.get_int('prefetch-concurrency')),
+                                     self.settings.get_int('prefetch-bandwidth') * 1024,
+                                     self.settings.get_boolean('prefetch-enclosures'), self.on_article_cached)
+
+        # the new prefetcher picks up where the old one left off
+        for feed in self.feeds:
+            self.engine.prefetch(item.entry for item in feed.items if item.unread)
+
+    def on_article_cached(self, url):
+        for feed in self.feeds:
+            for item in feed.items:
+                if item.link == url:
+                    item.update_cached()
+
+    def on_feed_fetched(self, feed, next_interval):
+        if feed in self.feeds:
+            self.scheduler.schedule(feed, next_interval)
+
+        # before that, items still in a feed may not have been touched for longer than the retention period
+        # simply because the applet wasn't running
+        if not self.compacting and all(feed.source.fetch_count for feed in self.feeds):
+            self.compacting = True
+            self.compact_read_state()
+            GLib.timeout_add_seconds(COMPACT_INTERVAL, self.compact_read_state)
+
+        if self.diagnostics_page.get_visible():
+            self.update_diagnostics()
+
+    def on_visible_feed_changed(self, *args):
+        page = self.feed_stack.get_visible_child()
+        self.timeline.set_visible(page == self.timeline.page)
+        if page == self.diagnostics_page:
+            self.update_diagnostics()
+        for feed in self.feeds:
+            if feed.page == page:
+                feed.ensure_loaded()
+
+    def on_search_changed(self, entry):
+        text = entry.get_text().strip()
+        if not text:
+            self.search_model.remove_all()
+            self.search_page.hide()
+            if self.page_before_search is not None and self.page_before_search.get_parent() is not None:
+                self.feed_stack.set_visible_child(self.page_before_search)
+            self.page_before_search = None
+            return
+
+        feeds = {feed.url: feed for feed in self.feeds}
+        items = [feeds[url].get_item(entry) for (url, entry) in self.engine.search_index.search(text) if url in feeds]
+        self.search_model.splice(0, self.search_model.get_n_items(), items)
+
+        if not self.search_page.get_visible():
+            self.page_before_search = self.feed_stack.get_visible_child()
+            self.search_page.show()
+            self.feed_stack.set_visible_child(self.search_page)
+
+    def show_diagnostics(self, *args):
+        self.diagnostics_page.show()
+        self.feed_stack.set_visible_child(self.diagnostics_page)
+        self.window.present()
+
+    # one row per feed with its last fetch and the average milliseconds per step over the recorded fetches
+    def update_diagnostics(self):
+        self.diagnostics_store.clear()
+        for feed in self.feeds:
+            diagnostics = feed.source.get_diagnostics()
+            last = diagnostics['history'][-1] if diagnostics['history'] else {}
+            average = diagnostics['average_ms']
+            timings = ['%.1f' % average[step] if step in average else '' for step in ('connect', 'wait', 'transfer', 'parse', 'apply')]
+
+            # the tree view shows the tooltip column as markup, and error messages are full of <, > and &
+            message = last.get('message')
+            tooltip = GLib.markup_escape_text(message) if message else None
 
-        self.check_feeds()
+            self.diagnostics_store.append([feed.name, last.get('status', ''), str(last.get('code') or ''), diagnostics['fetches'],
+                                           diagnostics['errors'], GLib.format_size(last.get('size', 0))] + timings + [message, tooltip])
+
+    def save_diagnostics(self, *args):
+        dialog = Gtk.FileChooserDialog(title='Save Diagnostics', transient_for=self.window, action=Gtk.FileChooserAction.SAVE,
+                                       do_overwrite_confirmation=True)
+        dialog.add_button('Cancel', Gtk.ResponseType.CANCEL)
+        dialog.add_button('Save', Gtk.ResponseType.ACCEPT)
+        dialog.set_current_name('feeds-diagnostics.json')
+
+        path = dialog.get_filename() if dialog.run() == Gtk.ResponseType.ACCEPT else None
+        dialog.destroy()
+        if path is None:
+            return
+
+        diagnostics = {
+            'feeds': [feed.source.get_diagnostics() for feed in self.feeds],
+            'validators': dict(self.engine.validators.stats)
+        }
+
+        try:
+            with open(path, 'w') as f:
+                json.dump(diagnostics, f, indent=2)
+        except OSError as e:
+            self.show_message('Could not write %s' % path, str(e))
+
+    def compact_read_state(self):
+        retention_days = self.settings.get_int('read-retention-days')
+        if retention_days <= 0:
+            return GLib.SOURCE_CONTINUE
+
+        # feeds that can't be fetched right now can't touch their items either
+        keep_urls = [feed.url for feed in self.feeds if feed.source.has_failed()]
+
+        def compact():
+            try:
+                removed = self.engine.read_state.compact(retention_days, keep_urls)
+            except sqlite3.Error:
+                traceback.print_exc()
+                return
+
+            if removed:
+                print('forgot %d read items' % removed)
+                GLib.idle_add(self.reload_read_ids)
+
+        threading.Thread(target=compact, daemon=True).start()
+
+        return GLib.SOURCE_CONTINUE
+
+    def reload_read_ids(self):
+        for feed in self.feeds:
+            feed.source.reload_read_ids()
+
+        return GLib.SOURCE_REMOVE
 
     def on_button_press(self, i, x, y, button, time, p):
         if button == 1:
@@ -281,10 +888,9 @@ class App(Gtk.Application):
 
     def check_feeds(self, *args):
         print('checking')
-        updates = False
+        print(self.engine.validators.describe_stats())
         for feed in self.feeds:
-            if feed.check_for_updates():
-                updates = True
+            feed.check_for_updates()
 
     def new_feed(self, *args):
         dialog = Gtk.Dialog()
@@ -316,8 +922,78 @@ class App(Gtk.Application):
             feeds.append((title, url))
             self.settings.set_value('subscribed-feeds', GLib.Variant('a(ss)', feeds))
 
-            self.update_feeds()
+        dialog.destroy()
 
+    def import_opml(self, *args):
+        dialog = Gtk.FileChooserDialog(title='Import Feeds', transient_for=self.window, action=Gtk.FileChooserAction.OPEN)
+        dialog.add_button('Cancel', Gtk.ResponseType.CANCEL)
+        dialog.add_button('Import', Gtk.ResponseType.ACCEPT)
+        file_filter = Gtk.FileFilter()
+        file_filter.set_name('OPML files')
+        file_filter.add_pattern('*.opml')
+        file_filter.add_pattern('*.xml')
+        dialog.add_filter(file_filter)
+
+        path = dialog.get_filename() if dialog.run() == Gtk.ResponseType.ACCEPT else None
+        dialog.destroy()
+        if path is None:
+            return
+
+        try:
+            imported = read_opml(path)
+        except (OSError, ET.ParseError) as e:
+            self.show_message('Could not read %s' % path, str(e))
+            return
+
+        subscribed = {url for (name, url) in self.settings.get_value('subscribed-feeds').unpack()}
+        pending = []
+        for (name, url) in imported:
+            if url not in subscribed:
+                subscribed.add(url)
+                pending.append((name, url))
+
+        if not pending:
+            self.show_message('Nothing to import', 'All feeds in %s are already subscribed.' % path)
+            return
+
+        # every url is checked on the fetch pool, and the valid ones are added with a single settings write
+        results = {}
+
+        def on_validated(result, url):
+            results[url] = result if result is not None else 'unexpected error'
+            if len(results) < len(pending):
+                return
+
+            feeds = self.settings.get_value('subscribed-feeds').unpack()
+            feeds.extend((name, url) for (name, url) in pending if results[url] is True)
+            self.settings.set_value('subscribed-feeds', GLib.Variant('a(ss)', feeds))
+
+            failed = ['%s: %s' % (url, results[url]) for (name, url) in pending if results[url] is not True]
+            self.show_message('Imported %d of %d feeds' % (len(pending) - len(failed), len(pending)), '\n'.join(failed))
+
+        for (name, url) in pending:
+            self.engine.validate(url, lambda result, url=url: on_validated(result, url))
+
+    def export_opml(self, *args):
+        dialog = Gtk.FileChooserDialog(title='Export Feeds', transient_for=self.window, action=Gtk.FileChooserAction.SAVE,
+                                       do_overwrite_confirmation=True)
+        dialog.add_button('Cancel', Gtk.ResponseType.CANCEL)
+        dialog.add_button('Export', Gtk.ResponseType.ACCEPT)
+        dialog.set_current_name('feeds.opml')
+
+        path = dialog.get_filename() if dialog.run() == Gtk.ResponseType.ACCEPT else None
+        dialog.destroy()
+        if path is None:
+            return
+
+        try:
+            write_opml(path, self.settings.get_value('subscribed-feeds').unpack())
+        except OSError as e:
+            self.show_message('Could not write %s' % path, str(e))
+
+    def show_message(self, text, secondary_text=''):
+        dialog = Gtk.MessageDialog(transient_for=self.window, buttons=Gtk.ButtonsType.CLOSE, text=text, secondary_text=secondary_text)
+        dialog.run()
         dialog.destroy()
 
     def on_unread_changed(self, *args):
@@ -329,6 +1005,8 @@ class App(Gtk.Application):
             else:
                 self.feed_stack.child_set(feed.page, needs_attention=False)
 
+        self.feed_stack.child_set(self.timeline.page, needs_attention=unread)
+
         if unread:
             self.status_icon.set_icon_name('feeds-new-symbolic')
         else:
@@ -336,6 +1014,7 @@ class App(Gtk.Application):
 
 
     def exit(self, *args):
+        self.engine.shutdown()
         self.quit()
 
 
@@ -1,9 +1,17 @@
 #!/usr/bin/python3
 
 import cairo
+import collections
 import math
+import mmap
+import os
+import re
+import struct
 import subprocess
 import sys
+import threading
+import time
+import traceback
 
 from random import random
 from setproctitle import setproctitle
@@ -26,6 +34,22 @@ REFRESH_INTERVAL = 2
 
 STYLE_SHEET_PATH = '/usr/share/status/monitor_temps.css'
 
+HWMON_PATH = '/sys/class/hwmon'
+HWMON_INPUT_PATTERN = re.compile(r'^(temp|fan)(\d+)_input$')
+
+NVIDIA_SMI_COMMAND = ('nvidia-smi', '--query-gpu=index,temperature.gpu,fan.speed,memory.used,memory.total',
+                      '--format=csv,noheader,nounits')
+GPU_FIELDS = ('temperature', 'fan', 'memory_used', 'memory_total')
+# seconds to wait before starting nvidia-smi again after it exited or failed to start
+GPU_RESTART_DELAY = 10
+
+# one reading of every sensor, values are None when they couldn't be read. gpus is a tuple of GpuSample.
+Sample = collections.namedtuple('Sample', ('time', 'cpu_max', 'cpu_ave', 'cpufan', 'sysfan1', 'sysfan2', 'gpus'))
+GpuSample = collections.namedtuple('GpuSample', ('index',) + GPU_FIELDS)
+
+# fan labels as lm-sensors prints them for unlabelled inputs, mapped to the meters showing them
+FAN_METERS = {'fan2': 'cpufan', 'fan3': 'sysfan1', 'fan4': 'sysfan2'}
+
 CSS_DATA = b"""
 levelbar block.filled {
     background-color: red;
@@ -46,6 +70,24 @@ levelbar block.warn {
 }
 """
 
+# (seconds per slot, number of slots) of each history tier: 2s for an hour, a minute for a day and 15
+# minutes for a month
+HISTORY_TIERS = ((2, 60 * 60 // 2), (60, 24 * 60), (15 * 60, 30 * 24 * 4))
+HISTORY_DTYPE = np.dtype([('time', 'f8'), ('min', 'f4'), ('max', 'f4'), ('mean', 'f4')])
+
+# every sample of a sensor is also appended to <name>.dat in HISTORY_DIR: a header of magic and record count
+# followed by fixed size records. The file grows by STORE_GROW_RECORDS at a time and records older than
+# STORE_RETENTION seconds are dropped when it is opened.
+HISTORY_DIR = os.path.join(GLib.get_user_data_dir(), 'status', 'temps')
+STORE_MAGIC = b'XSTEMPS1'
+STORE_HEADER = struct.Struct('<8sQ')
+STORE_DTYPE = np.dtype([('time', '<f8'), ('value', '<f4')])
+STORE_GROW_RECORDS = 64 * 1024
+STORE_RETENTION = 31 * 24 * 60 * 60
+STORE_TRIM_INTERVAL = 24 * 60 * 60
+
+GRAPH_RANGES = (('Last hour', 60 * 60), ('Last day', 24 * 60 * 60), ('Last month', 30 * 24 * 60 * 60))
+
 COLOR_MAP = {
     'cpu_max': [1, 0, 0],
     'cpu_ave': [0, 1, 0],
@@ -250,10 +292,202 @@ class DigitalDisplay(Gtk.Box):
     def set_value(self, value):
         self.current_value_label.set_label(f'{value:.0f}')
 
+# a fixed number of slots, once it is full each append overwrites the oldest one
+class RingBuffer(object):
+    def __init__(self, capacity):
+        self.slots = np.zeros(capacity, dtype=HISTORY_DTYPE)
+        self.position = 0
+        self.count = 0
+
+    def append(self, slot):
+        self.slots[self.position] = slot
+        self.position = (self.position + 1) % len(self.slots)
+        self.count = min(self.count + 1, len(self.slots))
+
+    # oldest first
+    def get(self):
+        if self.count < len(self.slots):
+            return self.slots[:self.count]
+
+        return np.concatenate((self.slots[self.position:], self.slots[:self.position]))
+
+# one resolution of a History: finished slots in a ring plus the slot that is still being filled
+class HistoryTier(object):
+    def __init__(self, step, capacity):
+        self.step = step
+        self.ring = RingBuffer(capacity)
+        self.slot = None
+        self.minimum = 0
+        self.maximum = 0
+        self.total = 0
+        self.count = 0
+
+    def get_duration(self):
+        return self.step * len(self.ring.slots)
+
+    # merges an aggregate into the current slot. Returns the previous slot as an aggregate if this started a
+    # new one, so it can be rolled up into the next tier.
+    def add(self, timestamp, minimum, maximum, total, count):
+        slot = int(timestamp // self.step)
+        if slot == self.slot:
+            self.minimum = min(self.minimum, minimum)
+            self.maximum = max(self.maximum, maximum)
+            self.total += total
+            self.count += count
+            return None
+
+        finished = self.flush()
+        self.slot = slot
+        self.minimum = minimum
+        self.maximum = maximum
+        self.total = total
+        self.count = count
+
+        return finished
+
+    def flush(self):
+        if not self.count:
+            return None
+
+        start = self.slot * self.step
+        self.ring.append((start, self.minimum, self.maximum, self.total / self.count))
+
+        return (start, self.minimum, self.maximum, self.total, self.count)
+
+    def get(self):
+        slots = self.ring.get()
+        if not self.count:
+            return slots
+
+        current = np.array([(self.slot * self.step, self.minimum, self.maximum, self.total / self.count)], dtype=HISTORY_DTYPE)
+        return np.concatenate((slots, current))
+
+# RRD style history of one sensor. Samples go into the finest tier and every finished slot is rolled up into
+# the next one, so memory stays the same however long the applet runs.
+class History(object):
+    def __init__(self, tiers=HISTORY_TIERS):
+        self.tiers = [HistoryTier(step, capacity) for (step, capacity) in tiers]
+
+    def append(self, timestamp, value):
+        aggregate = (timestamp, value, value, value, 1)
+        for tier in self.tiers:
+            aggregate = tier.add(*aggregate)
+            if aggregate is None:
+                break
+
+    def get_tier(self, duration):
+        for tier in self.tiers:
+            if tier.get_duration() >= duration:
+                return tier
+
+        return self.tiers[-1]
+
+    # slots of the finest tier that reaches back duration seconds, oldest first
+    def get(self, duration):
+        return self.get_tier(duration).get()
+
+# Append-only file of (time, value) records, memory-mapped so appending is a write into the map and a range
+# query is a view of the records in it rather than a copy. Records are assumed to be appended in time order.
+class SampleStore(object):
+    def __init__(self, path, retention=STORE_RETENTION):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        size = os.fstat(self.fd).st_size
+        self.count = 0
+        if size >= STORE_HEADER.size:
+            (magic, count) = STORE_HEADER.unpack(os.pread(self.fd, STORE_HEADER.size, 0))
+            if magic == STORE_MAGIC:
+                self.count = count
+            else:
+                print(f'{path} is not a sample store, starting over')
+                size = 0
+
+        capacity = max(size - STORE_HEADER.size, 0) // STORE_DTYPE.itemsize
+        self._map(max(capacity, STORE_GROW_RECORDS))
+        self.count = min(self.count, self.capacity)
+        self._write_count()
+
+        if retention:
+            self.trim(time.time() - retention)
+
+    # views handed out by query keep the previous map alive until they are dropped
+    def _map(self, capacity):
+        os.ftruncate(self.fd, STORE_HEADER.size + capacity * STORE_DTYPE.itemsize)
+        self.mmap = mmap.mmap(self.fd, 0)
+        self.records = np.frombuffer(self.mmap, dtype=STORE_DTYPE, count=capacity, offset=STORE_HEADER.size)
+        self.capacity = capacity
+
+    # written after the record, so a crash loses at most the sample being appended
+    def _write_count(self):
+        STORE_HEADER.pack_into(self.mmap, 0, STORE_MAGIC, self.count)
+
+    def append(self, timestamp, value):
+        if self.count == self.capacity:
+            self._map(self.capacity + STORE_GROW_RECORDS)
+
+        self.records[self.count] = (timestamp, value)
+        self.count += 1
+        self._write_count()
+
+    # records with start <= time < end
+    def query(self, start, end):
+        (first, last) = np.searchsorted(self.records['time'][:self.count], (start, end))
+        return self.records[first:last]
+
+    # drops the records older than cutoff by moving the rest to the start of the file
+    def trim(self, cutoff):
+        first = int(np.searchsorted(self.records['time'][:self.count], cutoff))
+        if not first:
+            return
+
+        self.records[:self.count - first] = self.records[first:self.count]
+        self.count -= first
+        self._write_count()
+
+    def close(self):
+        self.mmap.flush()
+        self.records = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            # a graph still holds a view, the map goes away with it
+            pass
+        os.close(self.fd)
+
+def open_store(name):
+    try:
+        return SampleStore(os.path.join(HISTORY_DIR, f'{name}.dat'))
+    except OSError as e:
+        print(f'could not open the history of {name}: {e}')
+        return None
+
+# records of a SampleStore merged into slots of step seconds, in the same form as History.get
+def bin_records(records, step):
+    if not len(records):
+        return np.zeros(0, dtype=HISTORY_DTYPE)
+
+    slots = (records['time'] // step).astype(np.int64)
+    starts = np.flatnonzero(np.diff(slots, prepend=slots[0] - 1))
+    counts = np.diff(np.append(starts, len(records)))
+    values = records['value']
+
+    binned = np.zeros(len(starts), dtype=HISTORY_DTYPE)
+    binned['time'] = slots[starts] * step
+    binned['min'] = np.minimum.reduceat(values, starts)
+    binned['max'] = np.maximum.reduceat(values, starts)
+    binned['mean'] = np.add.reduceat(values, starts, dtype=np.float64) / counts
+
+    return binned
+
 class GraphWindow(Gtk.Window):
-    def __init__(self, data=None):
+    def __init__(self, data=None, stores=None):
         super(GraphWindow, self).__init__(default_height=500, default_width=500)
         self.data = data
+        self.stores = stores or {}
+        # (sensor, duration) to the binned slots of its store from before its History starts
+        self.past = {}
 
         # self.drawing_area = Gtk.DrawingArea()
         # self.add(self.drawing_area)
@@ -261,8 +495,18 @@ class GraphWindow(Gtk.Window):
         self.figure = Figure()
         self.axis = self.figure.add_subplot(111)
 
+        box = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        self.add(box)
+
+        self.range_combo = Gtk.ComboBoxText(halign=Gtk.Align.END, margin=5)
+        for (label, duration) in GRAPH_RANGES:
+            self.range_combo.append_text(label)
+        self.range_combo.set_active(0)
+        self.range_combo.connect('changed', lambda *args: self.update_data(self.data))
+        box.pack_start(self.range_combo, False, False, 0)
+
         self.canvas = Canvas(self.figure)
-        self.add(self.canvas)
+        box.pack_start(self.canvas, True, True, 0)
 
         if data:
             self.update_data(data)
@@ -315,18 +559,36 @@ class GraphWindow(Gtk.Window):
     #         cr.stroke()
     #         cr.new_path()
 
+    # What the store holds from before the History of a sensor starts. That part no longer changes, so it
+    # is read and binned once per range rather than on every update.
+    def get_past(self, temp_id, store, step, duration, end):
+        key = (temp_id, duration)
+        if key not in self.past:
+            self.past[key] = bin_records(store.query(end - duration, end), step)
+
+        return self.past[key]
+
+    # data maps a sensor to its History, plotted as the mean with the min/max range shaded around it. For
+    # sensors with a store, the time before the applet started is filled in from it.
     def update_data(self, data):
         self.data = data
         self.axis.clear()
-        for temp_id, values in data.items():
-            # print(f'temp_id: {temp_id}')
-            time_array = np.arange(0, len(values), 1)
-            # print(f'values: {values}')
-            # print(f'time_array: {time_array}')
-            data_array = np.asarray(values)
-            # print(f'data_array: {data_array}')
-            self.axis.plot(time_array, data_array, label=temp_id)
 
+        duration = GRAPH_RANGES[self.range_combo.get_active()][1]
+        now = time.time()
+        for temp_id, history in data.items():
+            tier = history.get_tier(duration)
+            slots = tier.get()
+            store = self.stores.get(temp_id)
+            if store is not None:
+                end = slots['time'][0] if len(slots) else now // tier.step * tier.step
+                slots = np.concatenate((self.get_past(temp_id, store, tier.step, duration, end), slots))
+            slots = slots[slots['time'] >= now - duration]
+            minutes = (slots['time'] - now) / 60
+            line = self.axis.plot(minutes, slots['mean'], label=temp_id)[0]
+            self.axis.fill_between(minutes, slots['min'], slots['max'], color=line.get_color(), alpha=.2)
+
+        self.axis.set_xlabel('minutes')
         self.axis.legend()
         # self.drawing_area.queue_draw()
         self.canvas.draw()
@@ -335,6 +597,272 @@ class GraphWindow(Gtk.Window):
         self.hide()
         return Gdk.EVENT_STOP
 
+# an open hwmon input file, re-read from the start with pread on every sample
+class HwmonInput(object):
+    def __init__(self, path, label, scale):
+        self.label = label
+        self.scale = scale
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def read(self):
+        try:
+            return int(os.pread(self.fd, 32, 0)) / self.scale
+        except (OSError, ValueError):
+            return None
+
+    def close(self):
+        os.close(self.fd)
+
+# Reads temperatures and fan speeds straight from sysfs. The inputs are discovered once, and every sample
+# after that is one pread per input instead of running sensors.
+class HwmonReader(object):
+    def __init__(self, path=HWMON_PATH):
+        self.temps = []
+        self.fans = []
+
+        try:
+            chips = sorted(os.listdir(path))
+        except OSError:
+            chips = []
+
+        for chip in chips:
+            chip_path = os.path.join(path, chip)
+            try:
+                names = sorted(os.listdir(chip_path))
+            except OSError:
+                continue
+
+            for name in names:
+                match = HWMON_INPUT_PATTERN.match(name)
+                if not match:
+                    continue
+
+                (kind, index) = match.groups()
+                label = kind + index
+                try:
+                    with open(os.path.join(chip_path, f'{kind}{index}_label')) as f:
+                        label = f.read().strip()
+                except OSError:
+                    pass
+
+                try:
+                    if kind == 'temp':
+                        self.temps.append(HwmonInput(os.path.join(chip_path, name), label, 1000))
+                    else:
+                        self.fans.append(HwmonInput(os.path.join(chip_path, name), label, 1))
+                except OSError:
+                    pass
+
+    # True if the cpu temperatures that the meters need were found
+    def is_usable(self):
+        return any(sensor.label == 'Package id 0' or sensor.label.startswith('Core ') for sensor in self.temps)
+
+    # returns a dict of meter name to value, with the same meaning as the sensors output
+    def read(self):
+        readings = {}
+
+        core_temps = []
+        for sensor in self.temps:
+            if sensor.label == 'Package id 0':
+                value = sensor.read()
+                if value is not None:
+                    readings['cpu_max'] = value
+            elif sensor.label.startswith('Core '):
+                value = sensor.read()
+                if value is not None:
+                    core_temps.append(value)
+
+        if core_temps:
+            readings['cpu_ave'] = sum(core_temps) / len(core_temps)
+
+        for sensor in self.fans:
+            if sensor.label in FAN_METERS:
+                value = sensor.read()
+                if value is not None:
+                    readings[FAN_METERS[sensor.label]] = value
+
+        return readings
+
+    def close(self):
+        for sensor in self.temps + self.fans:
+            sensor.close()
+
+# the fallback for systems without a readable hwmon tree, parses the output of sensors
+class SensorsReader(object):
+    def read(self):
+        raw_info = subprocess.check_output('sensors', text=True)
+
+        entries = raw_info.split('\n')
+
+        readings = {}
+        core_temps = []
+        for entry in entries:
+            if entry[:13] == 'Package id 0:':
+                readings['cpu_max'] = float(entry[15:entry.find('°C')])
+            elif entry[:5] == 'Core ':
+                core_temps.append(float(entry[16:entry.find('°C')]))
+            elif entry[:4] in FAN_METERS:
+                readings[FAN_METERS[entry[:4]]] = float(entry[16:entry.find(' RPM')])
+
+        if core_temps:
+            readings['cpu_ave'] = sum(core_temps) / len(core_temps)
+
+        return readings
+
+    def close(self):
+        pass
+
+# Keeps one nvidia-smi running that prints a csv line per gpu every interval, and picks up whatever it has
+# printed since the last read without blocking. The command can be replaced, e.g. by a script printing the
+# same csv.
+class NvidiaSmiReader(object):
+    def __init__(self, interval=REFRESH_INTERVAL, command=None):
+        self.command = command or NVIDIA_SMI_COMMAND + ('-lms', str(int(interval * 1000)))
+        self.process = None
+        self.buffer = b''
+        self.gpus = {}
+        self.restart_time = 0
+
+    def _start(self):
+        try:
+            self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except FileNotFoundError:
+            # no nvidia driver, there won't ever be anything to read
+            print(f'{self.command[0]} not found, not reading gpus')
+            self.restart_time = math.inf
+            return
+        except OSError as e:
+            print(f'could not start {self.command[0]}: {e}')
+            self.restart_time = time.monotonic() + GPU_RESTART_DELAY
+            return
+
+        os.set_blocking(self.process.stdout.fileno(), False)
+
+    def _stop(self):
+        if self.process is None:
+            return
+
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(1)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+        self.process.stdout.close()
+        self.process = None
+        self.buffer = b''
+
+    # values are None where nvidia-smi reports [N/A] or [Not Supported]
+    def _parse_line(self, line):
+        fields = [field.strip() for field in line.decode(errors='replace').split(',')]
+        if len(fields) != len(GPU_FIELDS) + 1 or not fields[0].isdigit():
+            return
+
+        values = {}
+        for (name, field) in zip(GPU_FIELDS, fields[1:]):
+            try:
+                values[name] = float(field)
+            except ValueError:
+                values[name] = None
+
+        self.gpus[int(fields[0])] = values
+
+    # returns a dict of gpu index to the latest values read for it
+    def read(self):
+        if self.process is None:
+            if time.monotonic() >= self.restart_time:
+                self._start()
+            if self.process is None:
+                return dict(self.gpus)
+
+        exited = False
+        while True:
+            try:
+                chunk = os.read(self.process.stdout.fileno(), 65536)
+            except BlockingIOError:
+                break
+
+            if not chunk:
+                exited = True
+                break
+            self.buffer += chunk
+
+        lines = self.buffer.split(b'\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            self._parse_line(line)
+
+        if exited:
+            print(f'{self.command[0]} exited with status {self.process.wait()}, restarting')
+            self._stop()
+            self.gpus = {}
+            self.restart_time = time.monotonic() + GPU_RESTART_DELAY
+
+        return dict(self.gpus)
+
+    def close(self):
+        self._stop()
+
+def get_sensor_reader():
+    reader = HwmonReader()
+    if reader.is_usable():
+        return reader
+
+    reader.close()
+    return SensorsReader()
+
+# Reads the sensors every interval on its own thread, so a slow sensors or nvidia-smi never blocks the main
+# loop, and hands each Sample to callback on the main loop.
+class Sampler(object):
+    def __init__(self, callback, interval=REFRESH_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='sampler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        sensors = get_sensor_reader()
+        gpu = NvidiaSmiReader(self.interval)
+
+        next_time = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                sample = self.sample(sensors, gpu)
+            except Exception:
+                traceback.print_exc()
+            else:
+                GLib.idle_add(self.deliver, sample)
+
+            # a late sample pushes the schedule back rather than causing a burst of catch-up samples
+            now = time.monotonic()
+            next_time = max(next_time + self.interval, now)
+            self.stopped.wait(next_time - now)
+
+        sensors.close()
+        gpu.close()
+
+    def sample(self, sensors, gpu):
+        readings = sensors.read()
+        gpus = tuple(GpuSample(index, *(values[name] for name in GPU_FIELDS)) for (index, values) in sorted(gpu.read().items()))
+
+        return Sample(time.time(), readings.get('cpu_max'), readings.get('cpu_ave'), readings.get('cpufan'),
+                      readings.get('sysfan1'), readings.get('sysfan2'), gpus)
+
+    def deliver(self, sample):
+        if not self.stopped.is_set():
+            self.callback(sample)
+
+        return GLib.SOURCE_REMOVE
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join(1)
+
 class Monitor(Gtk.Application):
     def __init__(self):
         super(Monitor, self).__init__(application_id=APPLICATION_ID, flags=Gio.ApplicationFlags.FLAGS_NONE)
@@ -344,7 +872,12 @@ class Monitor(Gtk.Application):
 
         self.graph = None
 
-        self.data = {'cpu_max': [], 'cpu_ave': [], 'gpu': []}
+        self.data = {'cpu_max': History(), 'cpu_ave': History(), 'gpu': History()}
+        # opened in do_activate, so only the primary instance ever writes to them
+        self.stores = {}
+        self.trim_time = 0
+
+        self.sampler = Sampler(self.refresh)
 
     def do_activate(self):
         # try:
@@ -405,8 +938,9 @@ class Monitor(Gtk.Application):
         # self.test = SpeedMeter()
         # flow_box.add(self.test)
 
-        GLib.timeout_add_seconds(REFRESH_INTERVAL, self.refresh)
-        self.refresh()
+        self.stores = {name: open_store(name) for name in self.data}
+        self.trim_time = time.time() + STORE_TRIM_INTERVAL
+        self.sampler.start()
 
         provider = Gtk.CssProvider()
         provider.load_from_data(CSS_DATA)
@@ -435,8 +969,9 @@ class Monitor(Gtk.Application):
 
     def open_graph(self, *args):
         if not self.graph:
-            self.graph = GraphWindow(self.data)
+            self.graph = GraphWindow(self.data, self.stores)
         else:
+            self.graph.update_data(self.data)
             self.graph.show()
 
     def raise_window(self, *args):
@@ -464,48 +999,55 @@ class Monitor(Gtk.Application):
 
         return Gdk.EVENT_STOP
 
-    def refresh(self, *args):
-        raw_info = subprocess.check_output('sensors', text=True)
-
-        entries = raw_info.split('\n')
-
-        core_temps = []
-        for entry in entries:
-            if entry[:13] == 'Package id 0:':
-                cpu_max = float(entry[15:entry.find('°C')])
-                self.cpu_max.set_value(cpu_max)
-                self.data['cpu_max'].append(cpu_max)
-            elif entry[:5] == 'Core ':
-                core_temps.append(float(entry[16:entry.find('°C')]))
-            elif entry[:3] == 'fan':
-                if entry[3] == '2':
-                    self.cpufan.set_value(float(entry[16:entry.find(' RPM')]))
-                if entry[3] == '3':
-                    self.sysfan1.set_value(float(entry[16:entry.find(' RPM')]))
-                if entry[3] == '4':
-                    self.sysfan2.set_value(float(entry[16:entry.find(' RPM')]))
-
-        cpu_ave = sum(core_temps)/len(core_temps)
-        self.cpu_ave.set_value(cpu_ave)
-        self.data['cpu_ave'].append(cpu_ave)
-
-        raw_info = subprocess.check_output('nvidia-smi', text=True)
-        gpu_temp_line = raw_info.split('\n')[8]
-        gpu_fan = int(gpu_temp_line[1:gpu_temp_line.find('%')])
-        gpu_temp = float(gpu_temp_line[6:gpu_temp_line.find('C')])
-        gpu_mem_use = int(gpu_temp_line[34:gpu_temp_line.find('MiB')])
-        gpu_mem_max = int(gpu_temp_line[46:gpu_temp_line.find('MiB', 46)])
-
-        self.gpu_temp.set_value(gpu_temp)
-        self.data['gpu'].append(gpu_temp)
-        self.vram.set_value(gpu_mem_use, gpu_mem_max)
-
-        if self.graph:
+    # only applies the values of a sample taken by the sampler thread
+    def refresh(self, sample):
+        for name in ('cpu_max', 'cpu_ave'):
+            value = getattr(sample, name)
+            if value is not None:
+                getattr(self, name).set_value(value)
+                self.record(name, sample.time, value)
+
+        for name in FAN_METERS.values():
+            value = getattr(sample, name)
+            if value is not None:
+                getattr(self, name).set_value(value)
+
+        # the meters show the first gpu, the graph all of them
+        for gpu in sample.gpus:
+            if gpu.temperature is None:
+                continue
+
+            name = 'gpu' if gpu is sample.gpus[0] else f'gpu{gpu.index}'
+            self.record(name, sample.time, gpu.temperature)
+            if name == 'gpu':
+                self.gpu_temp.set_value(gpu.temperature)
+                if gpu.memory_used is not None and gpu.memory_total:
+                    self.vram.set_value(int(gpu.memory_used), int(gpu.memory_total))
+
+        # opening a store trims it, but the applet may run for much longer than the retention period
+        if sample.time >= self.trim_time:
+            self.trim_time = sample.time + STORE_TRIM_INTERVAL
+            for store in self.stores.values():
+                if store is not None:
+                    store.trim(sample.time - STORE_RETENTION)
+
+        if self.graph and self.graph.get_visible():
             self.graph.update_data(self.data)
 
-        return True
+    def record(self, name, timestamp, value):
+        if name not in self.data:
+            self.data[name] = History()
+            self.stores[name] = open_store(name)
+
+        self.data[name].append(timestamp, value)
+        if self.stores.get(name) is not None:
+            self.stores[name].append(timestamp, value)
 
     def exit(self, *args):
+        self.sampler.stop()
+        for store in self.stores.values():
+            if store is not None:
+                store.close()
         self.quit()
 
 if __name__ == '__main__':